@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# itunesDigests.py - Content digests of audio files, for matching files that were moved and re-tagged.
+# Used by itunestoND.py.
+
+import hashlib, os, sqlite3, struct
+from concurrent.futures import ThreadPoolExecutor
+
+# Partial digests cover the file size plus this many bytes from each end of the file
+DIGEST_BLOCK_SIZE = 64 * 1024
+# Files read at the same time; hashing is I/O bound, so more threads only add seeks
+HASH_WORKERS = 8
+
+# The digest cache lives next to the Navidrome database, e.g. navidrome.db.digests.cache
+DIGEST_CACHE_VERSION = 1
+DIGEST_CACHE_SUFFIX = '.digests.cache'
+
+def _digest_range(f, start, end):
+    """Digest of a byte range's length and its first and last DIGEST_BLOCK_SIZE bytes"""
+    length = end - start
+    digest = hashlib.blake2b(str(length).encode(), digest_size=16)
+    f.seek(start)
+    digest.update(f.read(min(length, DIGEST_BLOCK_SIZE)))
+    if length > DIGEST_BLOCK_SIZE:
+        f.seek(max(end - DIGEST_BLOCK_SIZE, start + DIGEST_BLOCK_SIZE))
+        digest.update(f.read(end - f.tell()))
+    return digest.hexdigest()
+
+def partial_digest(path, size):
+    """Digest of a file's size and its first and last DIGEST_BLOCK_SIZE bytes"""
+    with open(path, 'rb') as f:
+        return _digest_range(f, 0, size)
+
+def _skip_id3v2(f, start):
+    # ID3v2 tags (possibly several) at the start of MP3, AAC and some FLAC files
+    while True:
+        f.seek(start)
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            return start
+        size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | header[9] & 0x7f
+        start += 10 + size + (10 if header[5] & 0x10 else 0)
+
+def _skip_flac_metadata(f, start):
+    # fLaC marker followed by metadata blocks (STREAMINFO, VORBIS_COMMENT, PICTURE, ...)
+    f.seek(start)
+    if f.read(4) != b'fLaC':
+        return start
+    position = start + 4
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return position
+        position += 4 + int.from_bytes(header[1:], 'big')
+        if header[0] & 0x80:    # last metadata block
+            return position
+        f.seek(position)
+
+def _mp4_media_data(f, size):
+    # Top-level atoms; the audio is in mdat, the tags in moov/udta
+    position = 0
+    while position + 8 <= size:
+        f.seek(position)
+        atom_size, atom_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if atom_size == 1:
+            atom_size, header = struct.unpack('>Q', f.read(8))[0], 16
+        elif atom_size == 0:
+            atom_size = size - position
+        if atom_size < header:
+            break
+        if atom_type == b'mdat':
+            return position + header, min(position + atom_size, size)
+        position += atom_size
+    return None
+
+def _strip_trailing_tags(f, start, end):
+    # ID3v1 and APEv2 tags at the end of MP3 and AAC files, in either order
+    while end - start >= 32:
+        f.seek(end - 32)
+        footer = f.read(32)
+        if footer[:8] == b'APETAGEX':
+            tag_size, flags = struct.unpack('<II', footer[12:20])
+            end -= tag_size + (32 if flags & 0x80000000 else 0)
+            continue
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+                continue
+        return end
+    return end
+
+def audio_range(f, size):
+    """Byte range holding the audio frames of an MP3, AAC, FLAC or MP4/M4A file, leaving
+    out ID3, APE, Vorbis comment and MP4 metadata; other files are taken whole"""
+    f.seek(4)
+    if f.read(4) == b'ftyp':
+        media_data = _mp4_media_data(f, size)
+        if media_data is not None:
+            return media_data
+    start = _skip_flac_metadata(f, _skip_id3v2(f, 0))
+    return start, max(start, _strip_trailing_tags(f, start, size))
+
+def audio_digest(path, size):
+    """Digest of the audio payload of a file (its length and first and last
+    DIGEST_BLOCK_SIZE bytes), which stays the same when the file is re-tagged, or None
+    if no audio is left once the tags are skipped (e.g. a tag size pointing past the end)"""
+    with open(path, 'rb') as f:
+        start, end = audio_range(f, size)
+        if end <= start:
+            return None
+        return _digest_range(f, start, end)
+
+DIGESTERS = {'partial': partial_digest, 'audio': audio_digest}
+CONTENT_KINDS = tuple(DIGESTERS)
+
+def digest_cache_path(database_path):
+    """Where the digest cache for a Navidrome database is kept"""
+    return str(database_path) + DIGEST_CACHE_SUFFIX
+
+class DigestCache:
+    """Digests computed by earlier runs, keyed on (path, kind).
+
+    An entry is only reused while the file keeps the size and modification time it had
+    when it was hashed.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT,
+                PRIMARY KEY (path, kind)) WITHOUT ROWID;
+        ''')
+        version = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version != (str(DIGEST_CACHE_VERSION),):
+            self.conn.execute('DELETE FROM digests')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(DIGEST_CACHE_VERSION),))
+            self.conn.commit()
+        self.changed = []
+
+    def get(self, path, kind, stat):
+        row = self.conn.execute('SELECT size, mtime_ns, digest FROM digests WHERE path = ? AND kind = ?',
+                                (path, kind)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return row[2]
+
+    def put(self, path, kind, stat, digest):
+        self.changed.append((path, kind, stat.st_size, stat.st_mtime_ns, digest))
+
+    def close(self):
+        """Save the digests computed during this run"""
+        self.conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)', self.changed)
+        self.conn.commit()
+        self.conn.close()
+
+def _digest_file(path, kind):
+    try:
+        stat = os.stat(path)
+        digest = DIGESTERS[kind](path, stat.st_size)
+    except (OSError, struct.error):     # unreadable, or too damaged to find the audio in
+        return None, None
+    return (stat, digest) if digest is not None else (None, None)
+
+def compute_digests(paths, kind='partial', cache=None, workers=HASH_WORKERS):
+    """Digest each readable file in paths, returning a dictionary from path to digest.
+
+    Files are read by a pool of at most workers threads. Digests found in cache (a
+    DigestCache) are reused if the file is unchanged, and new ones are added to it.
+    Files that cannot be read, or hold no audio for kind 'audio', are left out.
+    """
+    digests = {}
+    missing = []
+    for path in dict.fromkeys(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        digest = cache.get(path, kind, stat) if cache is not None else None
+        if digest is None:
+            missing.append(path)
+        else:
+            digests[path] = digest
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, (stat, digest) in zip(missing, executor.map(_digest_file, missing, [kind] * len(missing))):
+            if digest is None:
+                continue
+            digests[path] = digest
+            if cache is not None:
+                cache.put(path, kind, stat, digest)
+    return digests
@@ -0,0 +1,933 @@
+#!/usr/bin/env python
+
+# itunesLibrary.py - Helpers for reading the iTunes Library.xml file.
+# Shared by itunestoND.py and itunesPlaylistMigrator.py.
+
+import array, base64, bz2, datetime, gzip, hashlib, io, lzma, mmap, operator, os, plistlib, re, sqlite3, sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from urllib.parse import unquote
+from xml.parsers import expat
+
+try:
+    from lxml import etree
+except ImportError:     # the expat and plistlib parsers still work without lxml
+    etree = None
+
+PLIST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'   # Example string: '2020-01-19T02:24:14Z'
+
+# Library paths can also be '-' to read from stdin. Compressed libraries are recognised by their magic bytes.
+STDIN = '-'
+COMPRESSION_MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+DECOMPRESSORS = {
+    'gzip': lambda stream: gzip.GzipFile(fileobj=stream, mode='rb'),
+    'bz2': bz2.BZ2File,
+    'xz': lzma.LZMAFile,
+}
+
+# Library.xml keys that make up a decoded track record, and the record field each one is stored in
+TRACK_FIELDS = {
+    'Track ID': 'track_id',
+    'Persistent ID': 'persistent_id',
+    'Location': 'location',
+    'Name': 'name',
+    'Artist': 'artist',
+    'Album': 'album',
+    'Track Number': 'track_number',
+    'Size': 'size',
+    'Total Time': 'total_time',
+    'Rating': 'rating',
+    'Play Count': 'play_count',
+    'Play Date UTC': 'play_date',
+}
+TRACK_DEFAULTS = {
+    'track_id': None,
+    'persistent_id': None,
+    'location': None,
+    'name': None,
+    'artist': None,
+    'album': None,
+    'track_number': None,
+    'size': None,       # bytes
+    'total_time': None, # milliseconds
+    'rating': 0,        # unrated in iTunes
+    'play_count': None,
+    'play_date': None,
+}
+# String fields that repeat across many tracks; interning them stores each value once
+TRACK_INTERNED_FIELDS = ('artist', 'album')
+# Types of the numeric and date keys of Library.xml entries, so that filter values compared
+# with them can be checked before the library is read
+FILTER_KEY_TYPES = dict.fromkeys(('Track ID', 'Size', 'Total Time', 'Disc Number', 'Disc Count', 'Track Number',
+                                  'Track Count', 'Year', 'Bit Rate', 'Sample Rate', 'Play Count', 'Skip Count',
+                                  'Rating', 'Album Rating', 'BPM', 'Playlist ID'), int)
+FILTER_KEY_TYPES.update(dict.fromkeys(('Date Modified', 'Date Added', 'Play Date UTC', 'Skip Date',
+                                       'Release Date'), datetime.datetime))
+FILTER_VALUE_NAMES = {int: 'a whole number', float: 'a number', datetime.datetime: 'a date like 2015-01-01'}
+
+# Byte patterns used to split the Tracks dictionary without parsing it. Track dicts are
+# flat, so a </dict> followed by a <key> can only be the boundary between two tracks.
+TRACKS_START = re.compile(rb'<key>Tracks</key>\s*<dict(/?)>')
+TRACKS_END = re.compile(rb'</dict>\s*</dict>')
+TRACKS_EMPTY = re.compile(rb'\s*</dict>')
+TRACK_BOUNDARY = re.compile(rb'</dict>(?=\s*<key>)')
+TRACK_ENTRY = re.compile(rb'<key>(\d+)</key>\s*(<dict>.*?</dict>)', re.DOTALL)
+TRACK_PERSISTENT_ID = re.compile(rb'<key>Persistent ID</key>\s*<string>([^<]*)</string>')
+
+# The Playlists array is the last entry of the library, so it can be found from the end of the file
+PLAYLISTS_KEY = b'<key>Playlists</key>'
+PLAYLISTS_START = re.compile(rb'<key>Playlists</key>\s*(<array>)')
+PLAYLISTS_END = re.compile(rb'</array>\s*</dict>\s*</plist>\s*$')
+SCAN_BLOCK_SIZE = 1 << 20
+
+PLAYLIST_FIELDS = {
+    'Name': 'name',
+    'Playlist ID': 'playlist_id',
+    'Playlist Persistent ID': 'persistent_id',
+    'Distinguished Kind': 'distinguished_kind',
+    'Smart Info': 'smart_info',
+}
+PLAYLIST_DEFAULTS = dict.fromkeys(list(PLAYLIST_FIELDS.values()) + ['track_ids'])
+
+# Parser engines. lxml and expat stream the library with flat memory use (lxml being the
+# faster of the two); plistlib loads the whole file at once and needs roughly
+# PLISTLIB_MEMORY_FACTOR times the file size in memory.
+PARSER_NAMES = ('auto', 'lxml', 'expat', 'plistlib')
+PLISTLIB_MEMORY_FACTOR = 4
+
+# Filter conditions (see RecordFilter) that keep only local music files
+MUSIC_ONLY_FILTER = ('Track Type=File', '!Podcast', '!Movie', '!TV Show', '!Music Video', '!Has Video')
+
+# The snapshot cache is a SQLite file stored next to the library (Library.xml.cache).
+# Bump SNAPSHOT_VERSION whenever the layout of the cached records changes.
+SNAPSHOT_VERSION = 5
+SNAPSHOT_SUFFIX = '.cache'
+
+def _compression(stream):
+    head = stream.peek(6)[:6]
+    return next((name for magic, name in COMPRESSION_MAGIC.items() if head.startswith(magic)), None)
+
+@contextmanager
+def open_library(library_path):
+    """Open Library.xml as a binary stream for the parser.
+
+    '-' reads from stdin. gzip, bzip2, xz and zstd compressed libraries are decompressed
+    on the fly (zstd needs the optional zstandard package).
+    """
+    with ExitStack() as stack:
+        if os.fspath(library_path) == STDIN:
+            stream = sys.stdin.buffer
+        else:
+            stream = stack.enter_context(open(library_path, 'rb'))
+
+        compression = _compression(stream)
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError('Reading a zstd compressed library needs the zstandard package (pip install zstandard).')
+            stream = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(stream))
+        elif compression is not None:
+            stream = stack.enter_context(DECOMPRESSORS[compression](stream))
+        yield stream
+
+def is_plain_file(library_path):
+    """Tell whether the library is an uncompressed file, which byte-level access (memory
+    mapping, byte offsets) needs"""
+    if os.fspath(library_path) == STDIN:
+        return False
+    with open(library_path, 'rb') as f:
+        return _compression(f) is None
+
+def plist_value(elem):
+    """Convert a plist XML element into the matching Python value"""
+    tag = elem.tag
+    if tag == 'dict':
+        children = iter(elem)
+        return {key.text: plist_value(value) for key, value in zip(children, children)}
+    if tag == 'array':
+        return [plist_value(child) for child in elem]
+    if tag == 'integer':
+        return int(elem.text)
+    if tag == 'real':
+        return float(elem.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.datetime.strptime(elem.text, PLIST_DATE_FORMAT)
+    if tag == 'data':
+        return base64.b64decode(elem.text or '')
+    return elem.text or ''
+
+class RecordFilter:
+    """Conditions on the raw Library.xml values of an entry, checked while it is decoded.
+
+    Each condition is written as 'Key OP value', for example 'Kind=MPEG audio file',
+    'Location^=file:///Volumes/Music/', 'Date Added>=2015-01-01' or 'Play Count>0'.
+    OP is one of = != ^= (starts with) ~= (contains) < <= > >=. A bare key ('Podcast')
+    requires the key to be present and true, and a leading ! ('!Podcast') requires it to
+    be missing or false. Locations are compared in their percent-decoded form. An entry
+    is kept only if it meets every condition; a missing key only meets != conditions.
+    """
+
+    OPERATORS = {
+        '=': operator.eq,
+        '!=': operator.ne,
+        '^=': lambda actual, expected: actual.startswith(expected),
+        '~=': lambda actual, expected: expected in actual,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+    }
+    CONDITION = re.compile(r'^\s*(!?)\s*([^!=<>^~]+?)\s*(?:(!=|\^=|~=|<=|>=|=|<|>)\s*(.*?))?\s*$')
+
+    def __init__(self, expressions):
+        self.expressions = list(expressions)
+        self.conditions = []    # (key, operator, value, negated) tuples
+        self._coerced = {}
+        for expression in self.expressions:
+            match = self.CONDITION.match(expression)
+            if match is None or (match.group(1) and match.group(3)):
+                raise ValueError(f'Invalid filter condition: {expression!r}')
+            negated, key, op, value = match.groups()
+            kind = FILTER_KEY_TYPES.get(key)
+            if op is not None and kind is not None:
+                if op in ('^=', '~='):
+                    raise ValueError(f'Invalid filter condition: {expression!r} ({op} only applies to text keys)')
+                self._expected(key, value, kind)
+            self.conditions.append((key, op, value, bool(negated)))
+        self.keys = frozenset(key for key, _, _, _ in self.conditions)
+
+    def __str__(self):
+        return '; '.join(self.expressions)
+
+    def _coerce(self, value, kind):
+        """Convert a condition's value to the type of the values it is compared with"""
+        cache_key = (value, kind)
+        if cache_key not in self._coerced:
+            if issubclass(kind, bool):
+                coerced = value.lower() in ('true', 'yes', '1')
+            elif issubclass(kind, int):
+                coerced = int(value)
+            elif issubclass(kind, float):
+                coerced = float(value)
+            elif issubclass(kind, datetime.datetime):
+                coerced = datetime.datetime.fromisoformat(value.rstrip('Z'))
+            else:
+                coerced = value
+            self._coerced[cache_key] = coerced
+        return self._coerced[cache_key]
+
+    def _expected(self, key, value, kind):
+        try:
+            return self._coerce(value, kind)
+        except ValueError:
+            raise ValueError(f'Filter value {value!r} cannot be compared with {key} values '
+                             f'(expected {FILTER_VALUE_NAMES.get(kind, kind.__name__)}).')
+
+    def accepts(self, values):
+        """Tell whether an entry with these raw values meets every condition"""
+        for key, op, value, negated in self.conditions:
+            actual = values.get(key)
+            if op is None:
+                if bool(actual) == negated:
+                    return False
+                continue
+            if actual is None:
+                if op != '!=':
+                    return False
+                continue
+            if key == 'Location':
+                actual = unquote(actual)
+            expected = self._expected(key, value, type(actual))
+            if not self.OPERATORS[op](actual, expected):
+                return False
+        return True
+
+class Track:
+    """A decoded iTunes track, as produced by every ingest path and used by every later stage.
+
+    Tracks use __slots__ instead of a per-instance dict, which keeps each record small even
+    for libraries with hundreds of thousands of them. Fields missing from Library.xml keep
+    their TRACK_DEFAULTS value.
+    """
+    __slots__ = tuple(TRACK_DEFAULTS)
+
+    def __init__(self, **fields):
+        for name, default in TRACK_DEFAULTS.items():
+            setattr(self, name, fields.get(name, default))
+
+    def __eq__(self, other):
+        if not isinstance(other, Track):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f'Track(track_id={self.track_id!r}, location={self.location!r})'
+
+def decode_track(elem, record_filter=None):
+    """Decode a track <dict> element into a typed track record.
+
+    The children are walked exactly once. Only the keys listed in TRACK_FIELDS (and the
+    keys a record_filter looks at) are converted; everything else is skipped without
+    being decoded. Tracks the filter rejects come back as None before any of their
+    other fields are decoded or a record is built. The Location is returned as a
+    percent-decoded file URL.
+    """
+    fields = []     # (field, key, value element) for each key a Track keeps
+    values = {} if record_filter is not None else None
+    children = iter(elem)
+    for key, value in zip(children, children):
+        name = key.text
+        if values is not None and name in record_filter.keys:
+            values[name] = plist_value(value)
+        field = TRACK_FIELDS.get(name)
+        if field is not None:
+            fields.append((field, name, value))
+    if values is not None and not record_filter.accepts(values):
+        return None
+
+    track = Track()
+    for field, name, value in fields:
+        # Keys the filter looked at have been decoded already
+        setattr(track, field, values[name] if values and name in values else plist_value(value))
+    return _finish_track(track)
+
+def _finish_track(track):
+    if track.location is not None:
+        track.location = unquote(track.location)
+    for field in TRACK_INTERNED_FIELDS:
+        value = getattr(track, field)
+        if value is not None:
+            setattr(track, field, sys.intern(value))
+    return track
+
+def track_from_plist(entry, record_filter=None):
+    """Build a track record from a track dictionary that has already been decoded (plistlib, expat)"""
+    if record_filter is not None and not record_filter.accepts(entry):
+        return None
+    track = Track(**{field: entry[key] for key, field in TRACK_FIELDS.items() if key in entry})
+    return _finish_track(track)
+
+def playlist_from_plist(entry, record_filter=None):
+    """Build a playlist record from a playlist dictionary that has already been decoded (plistlib, expat)"""
+    if record_filter is not None and not record_filter.accepts(entry):
+        return None
+    playlist = dict(PLAYLIST_DEFAULTS)
+    for key, field in PLAYLIST_FIELDS.items():
+        if key in entry:
+            playlist[field] = entry[key]
+    if 'Playlist Items' in entry:
+        playlist['track_ids'] = [item['Track ID'] for item in entry['Playlist Items'] if 'Track ID' in item]
+    return playlist
+
+def decode_playlist(elem, record_filter=None):
+    """Decode a playlist <dict> element into a record with its name, flags and track IDs"""
+    playlist = dict(PLAYLIST_DEFAULTS)   # track_ids stays None when the playlist has no Playlist Items at all
+    values = {} if record_filter is not None else None
+    children = iter(elem)
+    for key, value in zip(children, children):
+        if values is not None and key.text in record_filter.keys:
+            values[key.text] = plist_value(value)
+        if key.text == 'Playlist Items':
+            playlist['track_ids'] = [int(item_value.text)
+                                     for item in value
+                                     for item_key, item_value in zip(item[::2], item[1::2])
+                                     if item_key.text == 'Track ID']
+            continue
+        field = PLAYLIST_FIELDS.get(key.text)
+        if field is not None:
+            playlist[field] = plist_value(value)
+    if values is not None and not record_filter.accepts(values):
+        return None
+    return playlist
+
+def _release(elem):
+    """Free an element that has been consumed, along with any siblings before it"""
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def _lxml_section(library_path, section, header=None, record_filter=None):
+    """Stream the entries of one top-level section (Tracks or Playlists) of Library.xml with lxml.
+
+    Each entry is passed to decode and freed as soon as it has been yielded, so memory
+    use stays flat no matter how large the library is. Sections before the requested
+    one are skipped element by element and parsing stops once the section is done.
+    If a header dictionary is passed in, the top-level scalar entries (Music Folder,
+    Library Persistent ID, ...) are stored in it as they are read.
+    """
+    decode = ELEMENT_DECODERS[section]
+    with open_library(library_path) as stream:
+        context = etree.iterparse(stream, events=('start', 'end'), remove_comments=True, huge_tree=True)
+        depth = 0
+        top_key = None
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+
+            # plist = 1, library dict = 2, top-level entries = 3, section entries = 4, their fields = 5+
+            if depth == 3:
+                if elem.tag == 'key':
+                    top_key = elem.text
+                elif top_key == section:
+                    break
+                elif header is not None and elem.tag not in ('dict', 'array'):
+                    header[top_key] = plist_value(elem)
+                _release(elem)
+            elif depth == 4:
+                if top_key == section and elem.tag != 'key':
+                    record = decode(elem, record_filter)
+                    if record is not None:
+                        yield record
+                _release(elem)
+            depth -= 1
+        del context
+
+def _plist_scalar(tag, text):
+    if tag == 'integer':
+        return int(text)
+    if tag == 'real':
+        return float(text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.datetime.strptime(text, PLIST_DATE_FORMAT)
+    if tag == 'data':
+        return base64.b64decode(text)
+    return text
+
+class _ExpatSection:
+    """expat handlers that rebuild the entries of one section of Library.xml as plain plist
+    values. Finished entries are collected in entries until the caller takes them."""
+
+    def __init__(self, section, header):
+        self.section = section
+        self.header = header
+        self.entries = []
+        self.done = False
+        self.depth = 0
+        self.top_key = None
+        self.stack = []     # [container, pending dict key] for each dict/array being built
+        self.text = []
+
+    def start(self, name, attrs):
+        self.depth += 1
+        self.text = []
+        if name in ('dict', 'array') and self.depth >= 4 and self.top_key == self.section:
+            self.stack.append([{} if name == 'dict' else [], None])
+
+    def end(self, name):
+        depth = self.depth
+        self.depth -= 1
+        # plist = 1, library dict = 2, top-level entries = 3, section entries = 4, their fields = 5+
+        if depth == 3:
+            if name == 'key':
+                self.top_key = ''.join(self.text)
+            elif self.top_key == self.section:
+                self.done = True
+            elif self.header is not None and name not in ('dict', 'array'):
+                self.header[self.top_key] = _plist_scalar(name, ''.join(self.text))
+            return
+        if depth < 4 or self.top_key != self.section:
+            return
+
+        if name == 'key':
+            if self.stack:      # keys of the section itself (Track IDs) are not needed
+                self.stack[-1][1] = ''.join(self.text)
+            return
+        if name in ('dict', 'array'):
+            value = self.stack.pop()[0]
+        else:
+            value = _plist_scalar(name, ''.join(self.text))
+
+        if not self.stack:
+            self.entries.append(value)
+        elif isinstance(self.stack[-1][0], dict):
+            self.stack[-1][0][self.stack[-1][1]] = value
+        else:
+            self.stack[-1][0].append(value)
+
+    def characters(self, data):
+        self.text.append(data)
+
+def _expat_section(library_path, section, header=None, record_filter=None):
+    """Stream the entries of one section of Library.xml with the stdlib expat parser"""
+    handler = _ExpatSection(section, header)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+    record = PLIST_DECODERS[section]
+    with open_library(library_path) as stream:
+        while not handler.done:
+            block = stream.read(SCAN_BLOCK_SIZE)
+            parser.Parse(block, not block)
+            for entry in handler.entries:
+                decoded = record(entry, record_filter)
+                if decoded is not None:
+                    yield decoded
+            handler.entries.clear()
+            if not block:
+                break
+
+def _plistlib_section(library_path, section, header=None, record_filter=None):
+    """Load the whole of Library.xml with plistlib and return the entries of one section"""
+    with open_library(library_path) as stream:
+        library = plistlib.loads(stream.read(), fmt=plistlib.FMT_XML)
+    if header is not None:
+        header.update((key, value) for key, value in library.items() if not isinstance(value, (dict, list)))
+    entries = library.get(section, {})
+    if isinstance(entries, dict):
+        entries = entries.values()
+    record = PLIST_DECODERS[section]
+    records = (record(entry, record_filter) for entry in entries)
+    return [entry for entry in records if entry is not None]
+
+# Each section is decoded straight from lxml elements, or from the plain values the other engines produce
+ELEMENT_DECODERS = {'Tracks': decode_track, 'Playlists': decode_playlist}
+PLIST_DECODERS = {'Tracks': track_from_plist, 'Playlists': playlist_from_plist}
+PARSERS = {'lxml': _lxml_section, 'expat': _expat_section, 'plistlib': _plistlib_section}
+
+def _available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):   # not available on macOS and Windows
+        return None
+
+def _fits_in_memory(library_path):
+    if not is_plain_file(library_path):
+        return False    # the decompressed size is not known up front
+    available = _available_memory()
+    return available is None or os.path.getsize(library_path) * PLISTLIB_MEMORY_FACTOR < available // 2
+
+def choose_parser(library_path, requested='auto'):
+    """Pick the parser engine for a library.
+
+    'auto' uses lxml, the fastest engine, and expat when lxml is not installed. plistlib
+    is only used when asked for, and only if the file fits in the memory available;
+    otherwise the library is streamed with expat instead.
+    """
+    if requested == 'auto':
+        return 'lxml' if etree is not None else 'expat'
+    if requested == 'lxml' and etree is None:
+        raise ValueError('The lxml parser was requested but lxml is not installed.')
+    if requested == 'plistlib' and not _fits_in_memory(library_path):
+        print('The library is too large to load with plistlib in the memory available. Using expat instead.')
+        return 'expat'
+    return requested
+
+def _iter_section(library_path, section, header=None, parser='auto', record_filter=None):
+    return PARSERS[choose_parser(library_path, parser)](library_path, section, header, record_filter)
+
+def iter_tracks(library_path, header=None, parser='auto', record_filter=None):
+    """Stream the tracks of Library.xml as decoded track records, one at a time.
+
+    parser is one of PARSER_NAMES; 'auto' picks an engine with choose_parser(). Tracks
+    a RecordFilter rejects are dropped while they are decoded. iTunes writes the
+    top-level library entries before the Tracks section, so a header dictionary passed
+    in is filled by the time the first track is yielded.
+    """
+    return _iter_section(library_path, 'Tracks', header, parser, record_filter)
+
+def _find_playlists(library_path):
+    """Return the byte range of the Playlists array, or None if it cannot be located safely"""
+    with open(library_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            key = buf.rfind(PLAYLISTS_KEY)
+            start = PLAYLISTS_START.match(buf, key) if key >= 0 else None
+            end = PLAYLISTS_END.search(buf, key) if start else None
+            if end is None:
+                return None
+            return start.start(1), end.start() + len(b'</array>')
+
+def _scan_playlists(library_path, start, end):
+    """Stream the playlists in one byte range of Library.xml without touching the rest of the file"""
+    parser = etree.XMLPullParser(events=('start', 'end'), remove_comments=True, huge_tree=True)
+    depth = 0
+    with open(library_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(SCAN_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            parser.feed(block)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    continue
+                # Playlists array = 1, playlists = 2, their fields = 3+
+                if depth == 2:
+                    if elem.tag == 'dict':
+                        yield decode_playlist(elem)
+                    _release(elem)
+                depth -= 1
+    parser.close()
+
+def iter_playlists(library_path, header=None, parser='auto'):
+    """Stream the playlists of Library.xml as decoded playlist records, one at a time.
+
+    The Playlists array is located at byte level and parsed on its own, so the Tracks
+    section (usually most of the file) is never parsed. For compressed or piped
+    libraries, if the array cannot be found that way, or if a parser other than lxml
+    is requested, the whole file is read with the chosen parser instead.
+    """
+    parser = choose_parser(library_path, parser)
+    span = None
+    if parser == 'lxml' and is_plain_file(library_path):
+        span = _find_playlists(library_path)
+    if span is None:
+        return _iter_section(library_path, 'Playlists', header, parser)
+    if header is not None:
+        header.update(read_library_header(library_path))
+    return _scan_playlists(library_path, *span)
+
+def read_library_header(library_path):
+    """Read the top-level library entries that come before the Tracks section"""
+    header = {}
+    tracks = iter_tracks(library_path, header=header)
+    next(tracks, None)
+    tracks.close()
+    return header
+
+def _tracks_span(buf):
+    """Return the byte range holding the entries of the Tracks dictionary of a mapped Library.xml"""
+    start = TRACKS_START.search(buf)
+    if start is None:
+        raise ValueError('No Tracks dictionary found in the iTunes library.')
+    empty, start = start.group(1), start.end()
+    if empty or TRACKS_EMPTY.match(buf, start):     # <dict/> or <dict></dict>
+        return start, start
+    return start, TRACKS_END.search(buf, start).start() + len(b'</dict>')
+
+def _split_tracks(buf, jobs):
+    """Split the Tracks dictionary of a mapped Library.xml into byte ranges on track boundaries"""
+    start, end = _tracks_span(buf)
+    ranges = []
+    step = max(1, (end - start) // jobs)
+    range_start = start
+    while range_start < end:
+        boundary = TRACK_BOUNDARY.search(buf, min(range_start + step, end), end)
+        range_end = boundary.end() if boundary else end
+        ranges.append((range_start, range_end))
+        range_start = range_end
+    return ranges
+
+def _decode_track_range(library_path, start, end, record_filter=None):
+    """Decode every track in one byte range of the Tracks dictionary (runs in a worker process)"""
+    with open(library_path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    tracks = []
+    context = etree.iterparse(io.BytesIO(b'<dict>' + chunk + b'</dict>'), events=('end',), tag='dict',
+                              remove_comments=True, huge_tree=True)
+    for event, elem in context:
+        if elem.getparent() is None:
+            break
+        track = decode_track(elem, record_filter)
+        if track is not None:
+            tracks.append(track)
+        _release(elem)
+    return tracks
+
+def load_tracks_parallel(library_path, jobs, header=None, record_filter=None):
+    """Decode the Tracks section of Library.xml in several worker processes.
+
+    The file is memory-mapped and the Tracks dictionary is split into byte ranges that
+    start and end on track boundaries. Each range is decoded in its own process and the
+    track records are returned sorted by Track ID.
+    """
+    if header is not None:
+        header.update(read_library_header(library_path))
+
+    with open(library_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            ranges = _split_tracks(buf, jobs)
+    if not ranges:      # empty Tracks dictionary
+        return []
+
+    tracks = []
+    paths = [os.fspath(library_path)] * len(ranges)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        filters = [record_filter] * len(ranges)
+        for decoded in executor.map(_decode_track_range, paths, *zip(*ranges), filters):
+            tracks.extend(decoded)
+    tracks.sort(key=operator.attrgetter('track_id'))
+    return tracks
+
+def _encode_date(value):
+    return value.isoformat()
+
+def _decode_date(value):
+    return datetime.datetime.fromisoformat(value)
+
+def _encode_ids(value):
+    return array.array('q', value).tobytes()
+
+def _decode_ids(value):
+    return array.array('q', value).tolist()
+
+# Fields that need converting on their way in and out of the snapshot database
+SNAPSHOT_CODECS = {
+    'play_date': (_encode_date, _decode_date),
+    'track_ids': (_encode_ids, _decode_ids),
+    'artist': (str, sys.intern),
+    'album': (str, sys.intern),
+}
+SNAPSHOT_SECTIONS = {
+    'Tracks': ('tracks', list(TRACK_DEFAULTS), Track),
+    'Playlists': ('playlists', list(PLAYLIST_DEFAULTS), dict),
+}
+
+def snapshot_path(library_path):
+    """Return the path of the snapshot cache that belongs to a library file"""
+    library_path = Path(library_path)
+    return library_path.with_name(library_path.name + SNAPSHOT_SUFFIX)
+
+def _content_hash(library_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(library_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def open_snapshot(library_path):
+    """Open the snapshot cache of a library, emptying it if it no longer matches the file.
+
+    A snapshot is only reused when the library's size, modification time and content
+    hash are all the same as when it was written. The hash is only worked out once size
+    and modification time agree; a snapshot written from a freshly parsed library gets
+    its hash the first time it is reused.
+    """
+    stat = os.stat(library_path)
+    conn = sqlite3.connect(str(snapshot_path(library_path)))
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+    stored = dict(conn.execute('SELECT key, value FROM meta'))
+    current = {'version': SNAPSHOT_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if all(stored.get(key) == value for key, value in current.items()):
+        current['hash'] = _content_hash(library_path)
+        if stored.get('hash') is None:
+            conn.execute("INSERT INTO meta VALUES ('hash', ?)", (current['hash'],))
+            conn.commit()
+            return conn
+        if stored['hash'] == current['hash']:
+            return conn
+
+    conn.execute('DELETE FROM meta')
+    conn.execute('DROP TABLE IF EXISTS header')
+    conn.execute('CREATE TABLE header (key TEXT PRIMARY KEY, value, is_date INTEGER)')
+    conn.execute('DROP TABLE IF EXISTS sections')
+    conn.execute('CREATE TABLE sections (name TEXT PRIMARY KEY, filter TEXT)')
+    conn.execute('DROP TABLE IF EXISTS track_offsets')
+    conn.execute('CREATE TABLE track_offsets (track_id INTEGER PRIMARY KEY, persistent_id TEXT, start INTEGER, end INTEGER)')
+    conn.execute('CREATE INDEX track_offsets_persistent_id ON track_offsets (persistent_id)')
+    for table, columns, _ in SNAPSHOT_SECTIONS.values():
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute(f'CREATE TABLE {table} ({", ".join(columns)})')
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', current.items())
+    conn.commit()
+    return conn
+
+def _read_snapshot(conn, section, header, record_filter=None):
+    """Return the cached records of a section, or None if that section has not been cached
+    with the same filter"""
+    cached = conn.execute('SELECT filter FROM sections WHERE name = ?', (section,)).fetchone()
+    if cached is None or cached[0] != str(record_filter or ''):
+        return None
+    if header is not None:
+        for key, value, is_date in conn.execute('SELECT key, value, is_date FROM header'):
+            header[key] = _decode_date(value) if is_date else value
+
+    table, columns, record_type = SNAPSHOT_SECTIONS[section]
+    codecs = [(index, SNAPSHOT_CODECS[column][1]) for index, column in enumerate(columns) if column in SNAPSHOT_CODECS]
+    records = []
+    for row in conn.execute(f'SELECT {", ".join(columns)} FROM {table} ORDER BY rowid'):
+        row = list(row)
+        for index, decode in codecs:
+            if row[index] is not None:
+                row[index] = decode(row[index])
+        records.append(record_type(**dict(zip(columns, row))))
+    return records
+
+def _write_snapshot(conn, section, records, header, finish=None, record_filter=None):
+    """Pass records through while storing them in the snapshot; the section is only marked
+    complete (and committed) once every record has been consumed"""
+    table, columns, record_type = SNAPSHOT_SECTIONS[section]
+    insert = f'INSERT INTO {table} VALUES ({", ".join("?" * len(columns))})'
+    try:
+        for record in records:
+            if record_type is dict:
+                row = [record[column] for column in columns]
+            else:
+                row = [getattr(record, column) for column in columns]
+            for index, column in enumerate(columns):
+                if column in SNAPSHOT_CODECS and row[index] is not None:
+                    row[index] = SNAPSHOT_CODECS[column][0](row[index])
+            conn.execute(insert, row)
+            yield record
+
+        for key, value in (header or {}).items():
+            is_date = isinstance(value, datetime.datetime)
+            conn.execute('INSERT OR REPLACE INTO header VALUES (?, ?, ?)',
+                         (key, _encode_date(value) if is_date else value, is_date))
+        conn.execute('INSERT OR REPLACE INTO sections VALUES (?, ?)', (section, str(record_filter or '')))
+        if finish is not None:
+            finish(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _open_section(library_path, section, header, record_filter=None):
+    """Return (conn, records): the cached records of a section, or else a snapshot connection
+    ready to store them. Both are None if the snapshot cache cannot be used (e.g. the
+    library's folder is not writable), in which case the library is simply parsed."""
+    conn = None
+    try:
+        conn = open_snapshot(library_path)
+        cached = _read_snapshot(conn, section, header, record_filter)
+        if cached is not None:
+            conn.close()
+            return None, cached
+        conn.execute(f'DELETE FROM {SNAPSHOT_SECTIONS[section][0]}')
+        return conn, None
+    except (sqlite3.Error, OSError) as e:
+        if conn is not None:
+            conn.close()
+        print(f'Warning: not using the snapshot cache {snapshot_path(library_path)} ({e}).')
+        return None, None
+
+def load_tracks(library_path, jobs=1, header=None, use_cache=True, parser='auto', record_filter=None):
+    """Return the library's tracks, from the snapshot cache when it is still valid.
+
+    Otherwise the tracks are parsed (streamed, or with jobs worker processes) and stored
+    in the snapshot as they go by, so the next run can skip parsing altogether. Libraries
+    read from stdin are never cached, and compressed ones are always streamed.
+    """
+    plain_file = is_plain_file(library_path)
+    if jobs > 1 and plain_file and etree is not None:
+        tracks = lambda: load_tracks_parallel(library_path, jobs, header, record_filter)
+    else:
+        tracks = lambda: iter_tracks(library_path, header, parser, record_filter)
+    if not use_cache or os.fspath(library_path) == STDIN:
+        return tracks()
+
+    if header is None:
+        header = {}     # still needed in the snapshot, for callers that do want it
+    conn, cached = _open_section(library_path, 'Tracks', header, record_filter)
+    if cached is not None:
+        print(f'Loaded {len(cached):,} tracks from snapshot cache {snapshot_path(library_path)}.')
+        return cached
+    if conn is None:
+        return tracks()
+    def build_index(conn):
+        # The offset index is a cheap byte-level scan, so it is built alongside the first ingest;
+        # the tracks are still cached without it (TrackIndex builds it on first use instead)
+        if not plain_file:
+            return
+        try:
+            build_track_index(library_path, conn)
+        except (ValueError, OSError) as e:
+            print(f'Warning: could not index the tracks of {library_path} by byte offset ({e}).')
+    return _write_snapshot(conn, 'Tracks', tracks(), header, finish=build_index, record_filter=record_filter)
+
+def load_playlists(library_path, header=None, use_cache=True, parser='auto'):
+    """Return the library's playlists, from the snapshot cache when it is still valid"""
+    if not use_cache or os.fspath(library_path) == STDIN:
+        return iter_playlists(library_path, header, parser)
+
+    if header is None:
+        header = {}
+    conn, cached = _open_section(library_path, 'Playlists', header)
+    if cached is not None:
+        print(f'Loaded {len(cached):,} playlists from snapshot cache {snapshot_path(library_path)}.')
+        return cached
+    if conn is None:
+        return iter_playlists(library_path, header, parser)
+    return _write_snapshot(conn, 'Playlists', iter_playlists(library_path, header, parser), header)
+
+def build_track_index(library_path, conn):
+    """Record the byte range of every track of Library.xml in the snapshot's track_offsets table"""
+    def entries(buf):
+        start, end = _tracks_span(buf)
+        for entry in TRACK_ENTRY.finditer(buf, start, end):
+            persistent_id = TRACK_PERSISTENT_ID.search(buf, entry.start(2), entry.end(2))
+            yield (int(entry.group(1)), persistent_id and persistent_id.group(1).decode(),
+                   entry.start(2), entry.end(2))
+
+    with open(library_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            conn.execute('DELETE FROM track_offsets')
+            conn.executemany('INSERT INTO track_offsets VALUES (?, ?, ?, ?)', entries(buf))
+    conn.execute("INSERT OR REPLACE INTO sections VALUES ('TrackOffsets', '')")
+
+class TrackIndex:
+    """Random access to single tracks of Library.xml through the byte offsets stored in its
+    snapshot cache. The offsets are built on first use if the snapshot does not have them yet."""
+
+    def __init__(self, library_path):
+        self.library_path = library_path
+        self.conn = open_snapshot(library_path)
+        try:
+            if self.conn.execute("SELECT 1 FROM sections WHERE name = 'TrackOffsets'").fetchone() is None:
+                build_track_index(library_path, self.conn)
+                self.conn.commit()
+            self.file = open(library_path, 'rb')
+        except Exception:
+            self.conn.close()
+            raise
+
+    def _read(self, column, value):
+        row = self.conn.execute(f'SELECT start, end FROM track_offsets WHERE {column} = ?', (value,)).fetchone()
+        if row is None:
+            return None
+        start, end = row
+        self.file.seek(start)
+        return plistlib.loads(self.file.read(end - start), fmt=plistlib.FMT_XML)
+
+    def metadata(self, track_id):
+        """Return every Library.xml key of the track with this Track ID, or None if there is no such track"""
+        return self._read('track_id', track_id)
+
+    def get(self, track_id):
+        """Return the Track with this Track ID, or None if there is no such track"""
+        entry = self._read('track_id', track_id)
+        return track_from_plist(entry) if entry is not None else None
+
+    def get_by_persistent_id(self, persistent_id):
+        """Return the Track with this Persistent ID, or None if there is no such track"""
+        entry = self._read('persistent_id', persistent_id)
+        return track_from_plist(entry) if entry is not None else None
+
+    def close(self):
+        self.file.close()
+        self.conn.close()
+
+def open_track_index(library_path, use_cache=True):
+    """Return a TrackIndex for the library, or None if it cannot be accessed by byte offset
+    (it is not a plain file, or the snapshot cache is turned off or cannot be opened)"""
+    if not use_cache or not is_plain_file(library_path):
+        return None
+    try:
+        return TrackIndex(library_path)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f'Warning: not using the snapshot cache {snapshot_path(library_path)} ({e}).')
+        return None
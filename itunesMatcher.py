@@ -0,0 +1,730 @@
+#!/usr/bin/env python
+
+# itunesMatcher.py - Matches iTunes tracks to the media files of a Navidrome database.
+# Used by itunestoND.py.
+
+import json, multiprocessing, os, re, sqlite3, unicodedata
+from collections import namedtuple, deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+from itunesDigests import compute_digests, HASH_WORKERS
+
+# A Navidrome media_file row, and the outcome of matching one iTunes track against them
+MediaFile = namedtuple('MediaFile', 'id path artist_id album_id title artist album track_number size duration updated_at')
+Match = namedtuple('Match', 'media strategy score decision', defaults=(None,))
+# How a match was chosen among several candidates: how many there were, and the path and
+# features of the winner and of the runner-up
+Decision = namedtuple('Decision', 'candidates winner winner_features runner_up runner_up_features')
+CandidateFeatures = namedtuple('CandidateFeatures', 'suffix_depth size duration tags')
+# Fallback matchers to try when a track's path is not found: metadata is a flag, and
+# fuzzy_threshold the lowest fuzzy score accepted (None disables fuzzy matching)
+MatchOptions = namedtuple('MatchOptions', 'metadata fuzzy_threshold')
+
+MEDIA_FILE_QUERY = ('SELECT id, path, artist_id, album_id, title, artist, album, track_number, size, duration, '
+                    'updated_at FROM media_file')
+
+# Suffix trie nodes keep up to this many media files in a flat bucket before splitting on the next component
+SUFFIX_BUCKET_SIZE = 8
+
+NON_WORD = re.compile(r'[\W_]+')
+SEPARATORS = re.compile(r'[\\/]+')
+PATH_FORMS = ('NFC', 'NFD')
+
+# Tracks sent to a matching worker process at a time
+MATCH_CHUNK_SIZE = 500
+
+# The match cache lives next to the Navidrome database, e.g. navidrome.db.matches.cache
+MATCH_CACHE_VERSION = 2
+MATCH_CACHE_SUFFIX = '.matches.cache'
+
+# Rewrite rules files hold one 'iTunes prefix => Navidrome prefix' rule per line
+REWRITE_SEPARATOR = '=>'
+FILE_URL_PREFIXES = ('file://localhost/', 'file://')
+DRIVE_LETTER = re.compile(r'/?([A-Za-z]):(?=/|$)')
+
+# Seconds iTunes' Total Time and Navidrome's duration may differ by for the same file
+DURATION_TOLERANCE = 2
+# Confidence of a metadata match that is unique within its block
+METADATA_SCORES = {'size': 0.9, 'tags': 0.8}
+
+# Fuzzy matching: words ignored when comparing names, how many of a title's rarest words
+# pick its candidates (skipping words more common than FUZZY_MAX_POSTINGS), and the
+# weights of title, artist and duration in the score
+FUZZY_NOISE_WORDS = frozenset(('feat', 'ft', 'featuring', 'remaster', 'remastered', 'version',
+                               'edit', 'mono', 'stereo', 'the', 'a', 'and'))
+FUZZY_BLOCK_WORDS = 2
+FUZZY_MAX_POSTINGS = 1000
+FUZZY_WEIGHTS = (0.6, 0.3, 0.1)
+FUZZY_THRESHOLD = 0.75
+
+class PathCanonicalizer:
+    """Brings both sides of a path comparison into one canonical form: a Unicode
+    normalisation form, optionally case-folded and with backslashes and repeated slashes
+    reduced to single forward slashes"""
+
+    def __init__(self, form='NFC', casefold=False, separators=False):
+        self.form = form
+        self.casefold = casefold
+        self.separators = separators
+
+    def __call__(self, path):
+        if self.separators:
+            path = SEPARATORS.sub('/', path)
+        path = unicodedata.normalize(self.form, path)
+        return path.casefold() if self.casefold else path
+
+normalize_path = PathCanonicalizer()
+
+def normalize_name(name):
+    """Reduce a title or artist name to lower-case words, ignoring punctuation and spacing"""
+    return ' '.join(NON_WORD.sub(' ', unicodedata.normalize('NFKC', name).casefold()).split())
+
+def name_words(name):
+    """Set of significant words in a title or artist name, for fuzzy comparison"""
+    words = NON_WORD.sub(' ', unicodedata.normalize('NFKC', name or '').casefold()).split()
+    return frozenset(words).difference(FUZZY_NOISE_WORDS)
+
+def _dice(words, other):
+    if not words or not other:
+        return 0.0
+    return 2.0 * len(words & other) / (len(words) + len(other))
+
+def canonical_location(location):
+    """Reduce a file URL or local path (POSIX or Windows) to a plain path with forward slashes"""
+    for prefix in FILE_URL_PREFIXES:
+        if location.startswith(prefix):
+            location = '/' + location[len(prefix):].lstrip('/')
+            break
+    location = location.replace('\\', '/')
+    drive = DRIVE_LETTER.match(location)
+    if drive:
+        location = drive.group(1).upper() + ':' + location[drive.end():]
+    return location
+
+def path_components(path):
+    """Split a path into its components, file name first"""
+    return path.split('/')[::-1]
+
+def _common_depth(components, other, depth):
+    while depth < len(components) and depth < len(other) and components[depth] == other[depth]:
+        depth += 1
+    return depth
+
+class _SuffixNode:
+    __slots__ = ('bucket', 'children', 'size')
+
+    def __init__(self):
+        self.bucket = []        # media files stored flat at this node
+        self.children = None    # next component -> node, once the bucket has been split
+        self.size = 0           # media files in this subtree
+
+    def __iter__(self):
+        yield from self.bucket
+        for child in (self.children or {}).values():
+            yield from child
+
+class SuffixTrie:
+    """Navidrome paths keyed on their components from the file name backwards.
+
+    Looking up an iTunes path walks one node per component, so it costs time proportional
+    to the depth of the path whatever the size of the library. Nodes hold a small flat
+    bucket of media files and are only split on the next component when the bucket
+    overflows, which keeps the trie compact (most file names are unique).
+    """
+
+    def __init__(self, media_files=()):
+        self.root = _SuffixNode()
+        for media in media_files:
+            self.add(media)
+
+    def add(self, media):
+        self._insert(self.root, media, path_components(media.path), 0)
+
+    def _insert(self, node, media, components, depth):
+        while True:
+            node.size += 1
+            if node.children is None:
+                node.bucket.append(media)
+                if len(node.bucket) > SUFFIX_BUCKET_SIZE:
+                    self._split(node, depth)
+                return
+            if depth == len(components):    # the whole path ends at this node
+                node.bucket.append(media)
+                return
+            child = node.children.get(components[depth])
+            if child is None:
+                child = node.children[components[depth]] = _SuffixNode()
+            node = child
+            depth += 1
+
+    def _split(self, node, depth):
+        bucket, node.bucket, node.children = node.bucket, [], {}
+        node.size -= len(bucket)
+        for media in bucket:
+            self._insert(node, media, path_components(media.path), depth)
+
+    def ending_with(self, path):
+        """Find the media files whose paths end with every component of path.
+
+        The walk gives up at the first component no path has, so a path that matches
+        nothing costs no more than its depth, however many files share its file name.
+        """
+        components = path_components(path)
+        node, depth = self.root, 0
+        while node.children is not None and depth < len(components):
+            node = node.children.get(components[depth])
+            if node is None:
+                return []
+            depth += 1
+
+        if node.children is None:
+            # Flat bucket: keep the entries that also match beyond this node
+            return [media for media in node.bucket
+                    if _common_depth(components, path_components(media.path), depth) == len(components)]
+        return list(node)
+
+class SubstringMatcher:
+    """Aho-Corasick automaton over a set of paths, finding every one of them inside a text.
+
+    Building it costs time and memory proportional to the total length of the paths;
+    afterwards each text is scanned once, character by character, however many paths
+    there are.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.goto = [{}]        # state -> {character: next state}
+        self.output = [None]    # state -> index of the pattern ending there
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.output.append(None)
+                state = next_state
+            self.output[state] = index
+
+        # Breadth-first pass linking each state to the longest proper suffix that is also a
+        # state, and to the nearest state on that chain where a pattern ends
+        self.fail = [0] * len(self.goto)
+        self.next_output = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                link = self.goto[fallback].get(char, 0)
+                self.fail[child] = link
+                self.next_output[child] = link if self.output[link] is not None else self.next_output[link]
+
+    def search(self, text):
+        """Yield every pattern found in text (once per occurrence)"""
+        goto, fail, output, next_output = self.goto, self.fail, self.output, self.next_output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            hit = state if output[state] is not None else next_output[state]
+            while hit:
+                yield self.patterns[output[hit]]
+                hit = next_output[hit]
+
+class PathRewriter:
+    """iTunes location prefixes mapped to Navidrome path prefixes.
+
+    Prefixes are canonicalised (file URLs, percent-encoding, backslashes and drive
+    letters) and compiled into a trie of path components, so rewriting a location is a
+    single walk down its components, and the longest matching prefix wins. A rule with an
+    empty Navidrome prefix leaves the rest of the path relative, to be resolved by the
+    suffix matchers.
+    """
+
+    def __init__(self, rules=()):
+        self.root = {}
+        for itunes_prefix, navidrome_prefix in rules:
+            self.add(itunes_prefix, navidrome_prefix)
+
+    @staticmethod
+    def _components(path):
+        return canonical_location(unquote(path)).rstrip('/').split('/')
+
+    def add(self, itunes_prefix, navidrome_prefix, replace=True):
+        node = self.root
+        for component in self._components(itunes_prefix):
+            node = node.setdefault(component, {})
+        if replace or None not in node:
+            node[None] = navidrome_prefix.rstrip('/')
+
+    def rewrite(self, location):
+        """Split an (unquoted) iTunes location into its Navidrome prefix and the rest of the
+        path, or return None if no rule covers it"""
+        components = canonical_location(location).split('/')
+        node, found = self.root, None
+        for depth, component in enumerate(components):
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], depth + 1)
+        if found is None:
+            return None
+        navidrome_prefix, depth = found
+        return navidrome_prefix + '/' if navidrome_prefix else '', '/'.join(components[depth:])
+
+def load_rewrite_rules(path):
+    """Read a rewrite rules file into a PathRewriter; raises ValueError on malformed lines"""
+    rewriter = PathRewriter()
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            itunes_prefix, separator, navidrome_prefix = line.partition(REWRITE_SEPARATOR)
+            if not separator or not itunes_prefix.strip():
+                raise ValueError(f"{path}, line {number}: expected 'iTunes prefix {REWRITE_SEPARATOR} Navidrome prefix'")
+            rewriter.add(itunes_prefix.strip(), navidrome_prefix.strip())
+    return rewriter
+
+class AmbiguityResolver:
+    """Deterministic choice between several media files that match one track equally well.
+
+    Candidates are ranked by how many trailing path components they share with the iTunes
+    path, whether their size and duration agree with the track's, and how many of title,
+    artist, album and track number are equal, and finally by path. The normalised tags of
+    each media file are worked out once and kept.
+    """
+
+    def __init__(self):
+        self._tags = {}     # media file id -> normalised (title, artist, album)
+
+    def _media_tags(self, media):
+        tags = self._tags.get(media.id)
+        if tags is None:
+            tags = self._tags[media.id] = tuple(normalize_name(value) if value else None
+                                                for value in (media.title, media.artist, media.album))
+        return tags
+
+    def features(self, media, track=None, components=None):
+        """Describe how well a media file agrees with an iTunes Track and path components"""
+        depth = _common_depth(components, path_components(media.path), 0) if components else 0
+        if track is None:
+            return CandidateFeatures(depth, False, False, 0)
+        size = track.size is not None and media.size == track.size
+        duration = (track.total_time is not None and media.duration is not None
+                    and abs(media.duration - track.total_time / 1000) <= DURATION_TOLERANCE)
+        ours = self._media_tags(media)
+        theirs = (track.name, track.artist, track.album)
+        tags = sum(1 for mine, other in zip(ours, theirs) if mine and other and mine == normalize_name(other))
+        tags += media.track_number is not None and media.track_number == track.track_number
+        return CandidateFeatures(depth, size, duration, tags)
+
+    def resolve(self, candidates, track=None, song_path=None):
+        """Choose among candidate media files, returning (media, decision, ties): the
+        Decision is None when there was only one candidate, and ties counts the candidates
+        whose features are as good as the winner's"""
+        if len(candidates) == 1:
+            return candidates[0], None, 1
+        components = path_components(song_path) if song_path else None
+        ranked = sorted(((self.features(media, track, components), media) for media in candidates),
+                        key=lambda ranking: (tuple(-value for value in ranking[0]), ranking[1].path))
+        (best, winner), (second, runner_up) = ranked[:2]
+        ties = sum(1 for features, _ in ranked if features == best)
+        return winner, Decision(len(candidates), winner.path, best, runner_up.path, second), ties
+
+class MetadataIndex:
+    """Media files blocked on their tags, for tracks whose paths no longer match.
+
+    Renamed files keep their size and duration, re-tagged ones usually keep their title,
+    artist and duration, so media files are hashed on (size, rounded duration) and on
+    (normalised title, normalised artist). A track is only compared with the few media
+    files sharing one of its blocking keys; ties go to the AmbiguityResolver.
+    """
+
+    def __init__(self, media_files, resolver=None):
+        self.resolver = resolver or AmbiguityResolver()
+        self.by_size = {}
+        self.by_tags = {}
+        for media in media_files:
+            if media.size is not None and media.duration is not None:
+                self.by_size.setdefault((media.size, round(media.duration)), []).append(media)
+            if media.title and media.artist:
+                self.by_tags.setdefault((normalize_name(media.title), normalize_name(media.artist)), []).append(media)
+
+    def _pick(self, candidates, track, block):
+        media, decision, ties = self.resolver.resolve(candidates, track)
+        return Match(media, 'metadata', METADATA_SCORES[block] / ties, decision)
+
+    def match(self, track):
+        """Find the media file for an iTunes Track from its size, duration and tags, or None"""
+        seconds = track.total_time / 1000 if track.total_time is not None else None
+        if track.size is not None and seconds is not None:
+            candidates = [media for offset in (-1, 0, 1)
+                          for media in self.by_size.get((track.size, round(seconds) + offset), ())]
+            if candidates:
+                return self._pick(candidates, track, 'size')
+        if track.name and track.artist:
+            candidates = self.by_tags.get((normalize_name(track.name), normalize_name(track.artist)), ())
+            if seconds is not None:
+                candidates = [media for media in candidates
+                              if media.duration is None or abs(media.duration - seconds) <= DURATION_TOLERANCE]
+            if candidates:
+                return self._pick(candidates, track, 'tags')
+        return None
+
+class FuzzyIndex:
+    """Media files indexed by the words of their titles, for tracks whose tags differ slightly.
+
+    Each track is only compared with the media files sharing one of the rarest words of
+    its title, and scored on the overlap of title and artist words (ignoring things like
+    'feat.' and 'remastered') plus whether the durations agree. The best candidate is
+    accepted when its score reaches the threshold, and the score is its confidence.
+    """
+
+    def __init__(self, media_files, threshold=FUZZY_THRESHOLD):
+        self.threshold = threshold
+        self.media = []
+        self.words = []     # (title words, artist words) of each media file
+        self.postings = {}  # title word -> indexes into self.media
+        artists = {}
+        for media in media_files:
+            title = name_words(media.title)
+            artist = artists.get(media.artist)
+            if artist is None:
+                artist = artists[media.artist] = name_words(media.artist)
+            if not title:
+                continue
+            for word in title:
+                self.postings.setdefault(word, []).append(len(self.media))
+            self.media.append(media)
+            self.words.append((title, artist))
+
+    def _candidates(self, title):
+        rarest = sorted((word for word in title if 0 < len(self.postings.get(word, ())) <= FUZZY_MAX_POSTINGS),
+                        key=lambda word: len(self.postings[word]))
+        candidates = set()
+        for word in rarest[:FUZZY_BLOCK_WORDS]:
+            candidates.update(self.postings[word])
+        return candidates
+
+    def score(self, index, title, artist, seconds):
+        media_title, media_artist = self.words[index]
+        duration = self.media[index].duration
+        if seconds is None or duration is None:
+            agreement = 0.5
+        else:
+            agreement = 1.0 if abs(duration - seconds) <= DURATION_TOLERANCE else 0.0
+        title_weight, artist_weight, duration_weight = FUZZY_WEIGHTS
+        return (title_weight * _dice(title, media_title) + artist_weight * _dice(artist, media_artist)
+                + duration_weight * agreement)
+
+    def match(self, track):
+        """Find the media file whose tags best resemble an iTunes Track's, or None below the threshold"""
+        title, artist = name_words(track.name), name_words(track.artist)
+        seconds = track.total_time / 1000 if track.total_time is not None else None
+        best, best_score = None, self.threshold
+        for index in self._candidates(title):
+            score = self.score(index, title, artist, seconds)
+            if score > best_score or score == best_score and (best is None or self.media[index].path < best.path):
+                best, best_score = self.media[index], score
+        return Match(best, 'fuzzy', round(best_score, 3)) if best is not None else None
+
+class MediaIndex:
+    """Index of the Navidrome media files that iTunes paths are resolved against.
+
+    Navidrome paths are brought into canonical form once, when the index is built, and
+    stored in a dictionary; iTunes paths must be passed through the same canonical()
+    function before they are matched. An iTunes path relative to the Music Folder is
+    resolved by looking it up under each Navidrome root directory seen so far, so almost
+    every track costs a dictionary lookup. Paths that miss (including the first one under each root) are
+    looked up in a suffix trie, which finds the Navidrome paths ending with the iTunes
+    path whatever directory they live in; new roots are learned from those matches. Paths
+    whose file name several media files share always go through the trie as well, so that
+    every copy is weighed by the AmbiguityResolver rather than the first root that has one.
+    """
+
+    def __init__(self, media_files, canonical=normalize_path):
+        self.canonical = canonical
+        self.by_path = {}
+        self.by_id = {}
+        self.original_paths = {}    # media file id -> path as stored, where canonical() changed it
+        for media in media_files:
+            path = canonical(media.path)
+            if path != media.path:
+                self.original_paths[media.id] = media.path
+                media = media._replace(path=path)
+            self.by_path[media.path] = media
+            self.by_id[media.id] = media
+        self.suffixes = SuffixTrie(self.by_path.values())
+        names = Counter(path.rpartition('/')[2] for path in self.by_path)
+        self.shared_names = {name for name, count in names.items() if count > 1}
+        self.resolver = AmbiguityResolver()
+        self.roots = []
+        self._metadata = None   # built on first use, since most libraries never need them
+        self._fuzzy = None
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def _lookup(self, song_path):
+        """Find the media files at the iTunes path under each learned root"""
+        found = []
+        for root in self.roots:
+            media = self.by_path.get(root + song_path)
+            if media is not None and media not in found:
+                found.append(media)
+        return found
+
+    def _suffix(self, song_path):
+        """Find every Navidrome path that ends with the whole iTunes path"""
+        return self.suffixes.ending_with(song_path)
+
+    def match(self, song_path, root='', track=None):
+        """Find the media file for a canonical iTunes path, relative to the Navidrome
+        directory root if it is known (see PathRewriter), or None. The iTunes Track, if
+        given, helps choose between several files with the same path suffix."""
+        if root:
+            # A rewrite rule names the Navidrome directory outright, so its file wins over any copies
+            media = self.by_path.get(self.canonical(root) + song_path)
+            if media is not None:
+                return Match(media, 'exact', 1.0)
+        found = self._lookup(song_path)
+        if found and song_path.rpartition('/')[2] not in self.shared_names:
+            return Match(found[0], 'exact', 1.0)
+        strategy = 'exact' if found else 'suffix'
+        seen = {media.id for media in found}
+        found += [media for media in self._suffix(song_path) if media.id not in seen]
+        if not found:
+            return None
+        if len(found) > 1:
+            # Several directories hold this file; resolve it but do not learn a root from it
+            media, decision, ties = self.resolver.resolve(found, track, song_path)
+            return Match(media, strategy, 1.0 / ties, decision)
+        if strategy == 'suffix':
+            self.roots.append(found[0].path[:-len(song_path)])
+        return Match(found[0], strategy, 1.0)
+
+    def match_fallbacks(self, track, options):
+        """Match an iTunes Track whose path was not found with the fallbacks enabled in options"""
+        match = None
+        if options.metadata:
+            match = self.match_metadata(track)
+        if match is None and options.fuzzy_threshold is not None:
+            match = self.match_fuzzy(track, options.fuzzy_threshold)
+        return match
+
+    def prepare(self, options):
+        """Build the fallback indexes options will need now rather than on first use"""
+        if options.metadata and self._metadata is None:
+            self._metadata = MetadataIndex(self.by_path.values(), self.resolver)
+        if options.fuzzy_threshold is not None:
+            self.match_fuzzy(None, options.fuzzy_threshold)
+
+    def match_metadata(self, track):
+        """Find the media file for an iTunes Track whose path matched nothing, or None"""
+        if self._metadata is None:
+            self._metadata = MetadataIndex(self.by_path.values(), self.resolver)
+        return self._metadata.match(track)
+
+    def match_fuzzy(self, track, threshold=FUZZY_THRESHOLD):
+        """Find the media file whose tags best resemble an iTunes Track's, or None"""
+        if self._fuzzy is None or self._fuzzy.threshold != threshold:
+            self._fuzzy = FuzzyIndex(self.by_path.values(), threshold)
+        return self._fuzzy.match(track) if track is not None else None
+
+    def file_path(self, media):
+        """Path of a media file as Navidrome stores it, for reading the file itself"""
+        return self.original_paths.get(media.id, media.path)
+
+    def match_content(self, tracks, kind='partial', cache=None, workers=HASH_WORKERS, exclude=()):
+        """Match iTunes Tracks to the media files with the same content, as far as the files
+        on both sides can be read from here.
+
+        With kind 'partial' files are compared on their size and first and last blocks, so
+        only media files of the same size as one of the iTunes files are read. With kind
+        'audio' only the audio payload is compared, ignoring tags, so media files are
+        instead narrowed down to those of about the same duration. Media files whose ids
+        are in exclude (already matched to other tracks) are never read. Returns a Match or
+        None for each track.
+        """
+        locations = [canonical_location(track.location) if track.location else None for track in tracks]
+        candidates = [media for media in self.by_id.values() if media.id not in exclude]
+        if kind == 'partial':
+            sizes = set()
+            for location in locations:
+                try:
+                    sizes.add(os.path.getsize(location))
+                except (OSError, TypeError):
+                    pass
+            candidates = [media for media in candidates if media.size in sizes]
+        else:
+            seconds = {round(track.total_time / 1000) + offset for track in tracks if track.total_time is not None
+                       for offset in range(-DURATION_TOLERANCE, DURATION_TOLERANCE + 1)}
+            candidates = [media for media in candidates if media.duration is None or round(media.duration) in seconds]
+
+        itunes_digests = compute_digests((location for location in locations if location), kind, cache, workers)
+        navidrome_digests = compute_digests((self.file_path(media) for media in candidates), kind, cache, workers)
+        by_digest = {}
+        for media in candidates:
+            digest = navidrome_digests.get(self.file_path(media))
+            if digest is not None:
+                by_digest.setdefault(digest, []).append(media)
+        matches = []
+        for track, location in zip(tracks, locations):
+            found = by_digest.get(itunes_digests.get(location))
+            if found:
+                media, decision, ties = self.resolver.resolve(found, track)
+                matches.append(Match(media, 'content', 1.0 / ties, decision))
+            else:
+                matches.append(None)
+        return matches
+
+    def match_substrings(self, song_paths):
+        """Find the media files whose paths contain each canonical iTunes path anywhere, not just at the end.
+
+        Every Navidrome path is streamed once through an automaton built over all the iTunes
+        paths. Returns a dictionary from iTunes path to Match for the paths found; a path
+        contained in several media files goes to the AmbiguityResolver, which prefers the
+        ones ending with the most of its components.
+        """
+        matcher = SubstringMatcher(song_paths)
+        candidates = {}
+        for path, media in self.by_path.items():
+            for song_path in set(matcher.search(path)):
+                candidates.setdefault(song_path, []).append(media)
+
+        matches = {}
+        for song_path, found in candidates.items():
+            media, decision, ties = self.resolver.resolve(found, song_path=song_path)
+            matches[song_path] = Match(media, 'substring', 1.0 / ties, decision)
+        return matches
+
+def load_media_index(cur, canonical=normalize_path):
+    """Read every media file from the Navidrome database into a MediaIndex"""
+    cur.execute(MEDIA_FILE_QUERY)
+    return MediaIndex((MediaFile(*row) for row in cur.fetchall()), canonical)
+
+def match_cache_path(database_path):
+    """Where the match cache for a Navidrome database is kept"""
+    return str(database_path) + MATCH_CACHE_SUFFIX
+
+def _encode_decision(decision):
+    if decision is None:
+        return None
+    return json.dumps([decision.candidates, decision.winner, list(decision.winner_features),
+                       decision.runner_up, list(decision.runner_up_features)])
+
+def _decode_decision(value):
+    if value is None:
+        return None
+    candidates, winner, winner_features, runner_up, runner_up_features = json.loads(value)
+    return Decision(candidates, winner, CandidateFeatures(*winner_features),
+                    runner_up, CandidateFeatures(*runner_up_features))
+
+class MatchCache:
+    """Matches from earlier runs, keyed on (Persistent ID, canonical path).
+
+    Each entry records the media file a track was matched to, with that file's path and
+    updated_at at the time, and how it was chosen among several candidates if it was. An
+    entry is only reused while the media file still exists with the same path and
+    updated_at, so reruns only match tracks that are new or whose file changed. Entries
+    are discarded wholesale when the matching settings change.
+    """
+
+    def __init__(self, path, index, settings):
+        self.index = index
+        self.changed = {}
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+        expected = {'version': str(MATCH_CACHE_VERSION), 'settings': settings}
+        if meta != expected:
+            self.conn.execute('DROP TABLE IF EXISTS matches')
+            self.conn.execute('DELETE FROM meta')
+            self.conn.executemany('INSERT INTO meta VALUES (?, ?)', expected.items())
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS matches (
+                persistent_id TEXT, path TEXT, media_id TEXT, media_path TEXT, updated_at TEXT,
+                strategy TEXT, score REAL, decision TEXT, PRIMARY KEY (persistent_id, path)) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+        self.entries = {(persistent_id, path): entry for persistent_id, path, *entry
+                        in self.conn.execute('SELECT * FROM matches')}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, persistent_id, path):
+        """Return the cached Match for a track, or None if there is none or it is stale"""
+        entry = self.entries.get((persistent_id, path))
+        if entry is None:
+            return None
+        media_id, media_path, updated_at, strategy, score, decision = entry
+        media = self.index.by_id.get(media_id)
+        if media is None or media.path != media_path or str(media.updated_at) != updated_at:
+            return None
+        return Match(media, strategy, score, _decode_decision(decision))
+
+    def put(self, persistent_id, path, match):
+        media = match.media
+        entry = (media.id, media.path, str(media.updated_at), match.strategy, match.score,
+                 _encode_decision(match.decision))
+        if persistent_id is not None and self.entries.get((persistent_id, path)) != entry:
+            self.entries[persistent_id, path] = entry
+            self.changed[persistent_id, path] = entry
+
+    def close(self):
+        """Save the entries added or changed during this run"""
+        self.conn.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (key + entry for key, entry in self.changed.items()))
+        self.conn.commit()
+        self.conn.close()
+
+# The MediaIndex matching workers use. Under fork it is set before the pool starts, so the
+# workers inherit the parent's copy instead of unpickling their own.
+_worker_index = None
+
+def _set_worker_index(index):
+    global _worker_index
+    _worker_index = index
+
+def _match_fallbacks_chunk(tracks, options):
+    results = []
+    for track in tracks:
+        match = _worker_index.match_fallbacks(track, options)
+        if match is None:
+            results.append((track.track_id, None, None, None, None))
+        else:
+            results.append((track.track_id, match.media.id, match.strategy, match.score, match.decision))
+    return results
+
+def match_fallbacks_parallel(index, tracks, jobs, options):
+    """Run the fallback matchers enabled in options over tracks in jobs worker processes.
+
+    The metadata and fuzzy indexes are built once, before the workers start, and shared
+    with them (copy-on-write where processes are forked); workers send back only (track
+    id, media_file id, strategy, score, decision) tuples. Yields a Match or None for each track,
+    in order.
+    """
+    index.prepare(options)
+    chunks = [tracks[start:start + MATCH_CHUNK_SIZE] for start in range(0, len(tracks), MATCH_CHUNK_SIZE)]
+
+    context = multiprocessing.get_context()
+    if context.get_start_method() == 'fork':
+        _set_worker_index(index)
+        initializer, initargs = None, ()
+    else:
+        initializer, initargs = _set_worker_index, (index,)
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                 initializer=initializer, initargs=initargs) as executor:
+            for results in executor.map(_match_fallbacks_chunk, chunks, [options] * len(chunks)):
+                for track_id, media_id, strategy, score, decision in results:
+                    yield Match(index.by_id[media_id], strategy, score, decision) if media_id is not None else None
+    finally:
+        _set_worker_index(None)
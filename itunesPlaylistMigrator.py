@@ -6,9 +6,9 @@
 
 from pathlib import Path
 import sys, requests, urllib.parse, random, re, string, json, argparse, os
-from bs4 import BeautifulSoup
 import pyinputplus as pyip
 from hashlib import md5
+from itunesLibrary import load_playlists, open_track_index, PARSER_NAMES, STDIN
 
 try:
     from IT_file_correlations import *
@@ -60,7 +60,8 @@ def find_itunes_library():
         Path(os.path.expanduser('~/Music/iTunes')),
     ]
     
-    patterns = ['*[Ll]ibrary.xml', 'iTunes Library.xml', 'library.xml']
+    patterns = ['*[Ll]ibrary.xml', 'iTunes Library.xml', 'library.xml',
+                '*[Ll]ibrary.xml.gz', '*[Ll]ibrary.xml.zst', '*[Ll]ibrary.xml.bz2', '*[Ll]ibrary.xml.xz']
     
     for search_path in search_paths:
         if search_path.exists():
@@ -147,7 +148,7 @@ def setup_server_connection(server_url_arg=None, username_arg=None, password_arg
 
 def get_library_file(library_path=None):
     """Get iTunes library file with auto-detection"""
-    if library_path and library_path.is_file():
+    if library_path and (str(library_path) == STDIN or library_path.is_file()):
         print(f'Using provided library: {library_path}')
         return library_path
     
@@ -167,14 +168,19 @@ def get_library_file(library_path=None):
 
 def main():
     parser = argparse.ArgumentParser(description='Migrate iTunes playlists to Navidrome')
-    parser.add_argument('--library', type=Path, help='Path to iTunes Library.xml file')
+    parser.add_argument('--library', type=Path,
+                        help='Path to iTunes Library.xml file (may be gzip/bzip2/xz/zstd compressed, or - for stdin)')
     parser.add_argument('--server', help='Navidrome server URL')
     parser.add_argument('--username', help='Navidrome username')
     parser.add_argument('--password', help='Navidrome password')
     parser.add_argument('--batch', action='store_true', help='Accept all playlists without prompts')
     parser.add_argument('--preview', action='store_true', help='Preview playlists without processing')
+    parser.add_argument('--no-cache', action='store_true', help='Always re-parse the library instead of using its snapshot cache')
+    parser.add_argument('--parser', choices=PARSER_NAMES, default='auto', help='XML parser used to read the library (default: auto)')
     
     args = parser.parse_args()
+    if str(args.library) == STDIN and not ((args.batch or args.preview) and args.server and args.username and args.password):
+        parser.error('reading the library from stdin needs --batch or --preview and --server, --username and --password')
     
     # Setup server connection
     if not setup_server_connection(args.server, args.username, args.password):
@@ -184,9 +190,7 @@ def main():
     it_db_path = get_library_file(args.library)
     
     print('Loading iTunes playlists...')
-    with open(it_db_path, 'r', encoding='utf-8') as f: 
-        soup = BeautifulSoup(f, 'lxml-xml')
-    playlists = soup.array.find_all('dict', recursive=False)
+    playlists = list(load_playlists(it_db_path, use_cache=not args.no_cache, parser=args.parser))
     print(f'Found {len(playlists)} playlists to process.')
     
     # Determine processing mode
@@ -198,9 +202,9 @@ def main():
         processing_mode = get_playlist_processing_mode()
     
     # Process playlists
-    process_playlists(playlists, processing_mode)
+    process_playlists(playlists, processing_mode, library_path=it_db_path, use_cache=not args.no_cache)
 
-def process_playlists(playlists, processing_mode):
+def process_playlists(playlists, processing_mode, library_path=None, use_cache=True):
     """Process playlists based on selected mode"""
     playlists_to_skip = ('Library', 'Downloaded', 'Music', 'Movies', 'TV Shows', 'Podcasts', 'Audiobooks', 'Tagged', 'Genius')
     
@@ -212,18 +216,15 @@ def process_playlists(playlists, processing_mode):
     # First pass: collect playlist info
     valid_playlists = []
     for plist in playlists:
-        if plist.find('key', text='Distinguished Kind'): continue
+        if plist['distinguished_kind'] is not None: continue
         
-        playlist_name = plist.find('key', text='Name').find_next('string').text
+        playlist_name = plist['name']
         if playlist_name in playlists_to_skip: continue
-        if plist.find('key', text='Smart Info'): continue
+        if plist['smart_info'] is not None: continue
         
-        try:
-            playlist_tracks = plist.array.find_all('dict')
-            if playlist_tracks:
-                valid_playlists.append((playlist_name, playlist_tracks))
-        except AttributeError:
-            continue
+        playlist_tracks = plist['track_ids']
+        if playlist_tracks:
+            valid_playlists.append((playlist_name, playlist_tracks))
     
     if processing_mode == 'preview':
         print('\nPlaylist Preview:')
@@ -250,7 +251,7 @@ def process_playlists(playlists, processing_mode):
             continue
         
         ND_playlist_id = create_playlist_reply['playlist']['id']
-        it_track_ids = [int(track.integer.text) for track in playlist_tracks]
+        it_track_ids = playlist_tracks
         
         # Build list of Navidrome track IDs
         ND_track_ids = []
@@ -282,9 +283,16 @@ def process_playlists(playlists, processing_mode):
         print(f'Added {len(ND_track_ids)} tracks to "{playlist_name}"')
     
     # Print summary
-    print_summary(processed_playlists, skipped_playlists, all_missing_tracks)
+    print_summary(processed_playlists, skipped_playlists, all_missing_tracks, library_path, use_cache)
+
+def describe_track(track_index, track_id):
+    """Describe a track by its artist and name, looked up in the library's track index"""
+    track = track_index.get(track_id) if track_index else None
+    if not track:
+        return f'iTunes ID: {track_id}'
+    return f'iTunes ID: {track_id} - {track.artist or "Unknown Artist"} - {track.name or "Unknown"}'
 
-def print_summary(processed_playlists, skipped_playlists, all_missing_tracks):
+def print_summary(processed_playlists, skipped_playlists, all_missing_tracks, library_path=None, use_cache=True):
     """Print migration summary"""
     print('\n' + '='*60)
     print('MIGRATION SUMMARY')
@@ -311,14 +319,18 @@ def print_summary(processed_playlists, skipped_playlists, all_missing_tracks):
             print(f'  - {name}')
     
     if all_missing_tracks:
+        # Names are read straight from Library.xml through the byte offset index
+        track_index = open_track_index(library_path, use_cache) if library_path else None
         print(f'\nMISSING TRACKS DETAILS:')
         for playlist_name, missing_ids in all_missing_tracks.items():
             print(f'\n  {playlist_name} ({len(missing_ids)} missing):')
             for track_id in missing_ids[:5]:  # Show first 5
-                print(f'    iTunes ID: {track_id}')
+                print(f'    {describe_track(track_index, track_id)}')
             if len(missing_ids) > 5:
                 print(f'    ... and {len(missing_ids) - 5} more')
         print('\nNote: Missing tracks were likely skipped during the initial migration.')
+        if track_index:
+            track_index.close()
     
     print('\nMigration complete!')
 
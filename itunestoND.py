@@ -3,10 +3,12 @@
 # itunestoND.py - Transfers song ratings, playcounts and play dates from I-Tunes library
 # to the Navidrome database
 
-import sys, sqlite3, datetime, re, pprint, unicodedata, argparse, os
+import sys, sqlite3, pprint, argparse, os, csv
 from pathlib import Path
-from urllib.parse import unquote
-from bs4 import BeautifulSoup
+from itunesLibrary import load_tracks, RecordFilter, MUSIC_ONLY_FILTER, PARSER_NAMES, STDIN
+from itunesDigests import digest_cache_path, DigestCache, CONTENT_KINDS, HASH_WORKERS
+from itunesMatcher import (load_media_index, load_rewrite_rules, match_cache_path, match_fallbacks_parallel,
+                           MatchCache, MatchOptions, PathCanonicalizer, PathRewriter, FUZZY_THRESHOLD, PATH_FORMS)
 
 def find_files_by_pattern(pattern, search_paths=None):
     """Find files matching pattern in current directory and common locations"""
@@ -28,7 +30,8 @@ def auto_detect_itunes_library():
         Path(os.path.expanduser('~/Music/iTunes')),
     ]
     
-    patterns = ['*[Ll]ibrary.xml', 'iTunes Library.xml', 'library.xml']
+    patterns = ['*[Ll]ibrary.xml', 'iTunes Library.xml', 'library.xml',
+                '*[Ll]ibrary.xml.gz', '*[Ll]ibrary.xml.zst', '*[Ll]ibrary.xml.bz2', '*[Ll]ibrary.xml.xz']
     
     for pattern in patterns:
         files = find_files_by_pattern(pattern, search_paths)
@@ -99,37 +102,137 @@ def determine_userID(nd_p):
     conn.close()
     return users[0][0]
 
-def update_playstats(d1, id, playcount, playdate, rating=0):
-    d1.setdefault(id, {})
-    d1[id].setdefault('play count', 0)
-    d1[id].setdefault('play date', datetime.datetime.fromordinal(1))
-    d1[id]['play count'] += playcount
-    d1[id]['rating'] = rating
-
-    if playdate > d1[id]['play date']: d1[id].update({'play date': playdate})
-
-def write_to_annotation(dictionary_with_stats, entry_type, conn, cur):
-    annotation_entries = []
-    for item_id in dictionary_with_stats:
-        this_entry = dictionary_with_stats[item_id]
-        
-        play_count = this_entry['play count']
-        play_date = this_entry['play date'].strftime('%Y-%m-%d %H:%M:%S')
-        rating = this_entry['rating']
-
-        annotation_entries.append((userID, item_id, entry_type, play_count, play_date, rating, 0, None))
-
-    if annotation_entries:
-        cur.executemany('INSERT INTO annotation VALUES (?, ?, ?, ?, ?, ?, ?, ?)', annotation_entries)
-        conn.commit()
-        # cur.executemany('INSERT INTO consumers VALUES (?,?,?,?)', purchases)
-        # cur.execute("INSERT INTO consumers VALUES (1,'John Doe','john.doe@xyz.com','A')")
-
-def confirm_migration():
+# Play statistics of each matched iTunes track, from which the song, album and artist
+# annotations are rolled up; annotation_staging holds the rows about to be written
+STAGING_TABLES = '''
+    CREATE TEMP TABLE track_stats (media_file_id TEXT, play_count INTEGER, play_date DATETIME, rating INTEGER);
+    CREATE INDEX temp.track_stats_media_file ON track_stats (media_file_id);
+    CREATE TEMP TABLE annotation_staging (
+        user_id TEXT, item_id TEXT, item_type TEXT, play_count INTEGER, play_date DATETIME, rating INTEGER);
+'''
+
+def update_playstats(cur, song_id, playcount, playdate, rating=0):
+    cur.execute('INSERT INTO track_stats VALUES (?, ?, ?, ?)',
+                (song_id, playcount, playdate.strftime('%Y-%m-%d %H:%M:%S'), rating))
+
+def record_match(it_song_entry, song_path, match, navidrome_root=''):
+    if match is None and content_queue is not None:
+        # Try again once the content digests of all the unmatched files are known
+        content_queue.append((it_song_entry, song_path, navidrome_root))
+        return
+    if match is None:
+        print(f"Error while parsing {song_path}. Navidrome does not acknowledge that file's existence.")
+        print("Maybe Navidrome doesn't like the extension? Skipping.")
+        return
+    if match_cache is not None:
+        match_cache.put(it_song_entry.persistent_id, navidrome_root + song_path, match)
+    if match.strategy == 'fuzzy':
+        print(f'Fuzzy matched {song_path} to {match.media.path} (confidence {match.score:.2f})')
+    if match.decision is not None:
+        ambiguous_matches.append((song_path, match.strategy, match.decision))
+    song_id = match.media.id
+
+    # correlate Itunes ID with Navidrome ID (for use in a future script)
+    it_song_ID = it_song_entry.track_id
+    songID_correlation.update({it_song_ID: song_id})
+
+    # get rating, play count & date from Itunes
+    song_rating = int(it_song_entry.rating / 20)  # rating = 0 (unrated) if it's not rated in itunes
+    
+    play_count = it_song_entry.play_count
+    last_played = it_song_entry.play_date
+    if play_count is None or last_played is None:
+        return
+
+    update_playstats(cur, song_id, play_count, last_played, rating=song_rating)
+
+def write_ambiguous_matches(ambiguous_matches, path):
+    """Save how each track with several candidate files was resolved, for review"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['itunes_path', 'strategy', 'candidates', 'chosen', 'chosen_features', 'runner_up',
+                         'runner_up_features'])
+        for song_path, strategy, decision in ambiguous_matches:
+            writer.writerow([song_path, strategy, decision.candidates, decision.winner,
+                             dict(decision.winner_features._asdict()), decision.runner_up,
+                             dict(decision.runner_up_features._asdict())])
+
+# Annotation rows (item_id, play_count, play_date, rating) rolled up from track_stats. A song
+# matched by several iTunes tracks gets their combined plays and the rating of the last one;
+# albums and artists get the plays of their songs, and no rating of their own (iTunes has none)
+ANNOTATION_ROLLUPS = {
+    'media_file': '''
+        SELECT media_file_id AS item_id, sum(play_count) AS play_count, max(play_date) AS play_date,
+               (SELECT rating FROM track_stats AS last WHERE last.media_file_id = track_stats.media_file_id
+                ORDER BY rowid DESC LIMIT 1) AS rating
+        FROM track_stats GROUP BY media_file_id''',
+    'album': '''
+        SELECT media_file.album_id AS item_id, sum(play_count) AS play_count, max(play_date) AS play_date, 0 AS rating
+        FROM track_stats JOIN media_file ON media_file.id = track_stats.media_file_id
+        GROUP BY media_file.album_id''',
+    'artist': '''
+        SELECT media_file.artist_id AS item_id, sum(play_count) AS play_count, max(play_date) AS play_date, 0 AS rating
+        FROM track_stats JOIN media_file ON media_file.id = track_stats.media_file_id
+        GROUP BY media_file.artist_id''',
+}
+
+# Staged rows are written with a single INSERT ... ON CONFLICT DO UPDATE statement
+ANNOTATION_WRITE = '''
+    INSERT INTO annotation (user_id, item_id, item_type, play_count, play_date, rating, starred, starred_at)
+    SELECT user_id, item_id, item_type, play_count, play_date, rating, 0, NULL FROM annotation_staging WHERE true
+    ON CONFLICT (user_id, item_id, item_type) DO UPDATE SET {updates}
+'''
+
+# Overwriting only updates rows where a value changes; starred flags, album and artist
+# ratings and rows the migration does not produce are left alone
+ANNOTATION_OVERWRITE = '''
+        play_count = excluded.play_count, play_date = excluded.play_date,
+        rating = CASE WHEN excluded.item_type = 'media_file' THEN excluded.rating ELSE annotation.rating END
+    WHERE annotation.play_count IS NOT excluded.play_count OR annotation.play_date IS NOT excluded.play_date
+        OR (excluded.item_type = 'media_file' AND annotation.rating IS NOT excluded.rating)
+'''
+
+# Merge mode adds the iTunes play counts to the ones already in Navidrome and keeps the later
+# play date; how the two ratings combine is set by RATING_PRECEDENCE (0 means unrated)
+RATING_PRECEDENCE = {
+    'itunes': 'CASE WHEN excluded.rating > 0 THEN excluded.rating ELSE annotation.rating END',
+    'navidrome': 'CASE WHEN annotation.rating > 0 THEN annotation.rating ELSE excluded.rating END',
+    'max': 'max(coalesce(annotation.rating, 0), excluded.rating)',
+}
+ANNOTATION_MERGE = '''
+        play_count = coalesce(annotation.play_count, 0) + excluded.play_count,
+        play_date = CASE WHEN annotation.play_date IS NULL OR excluded.play_date > annotation.play_date
+                         THEN excluded.play_date ELSE annotation.play_date END,
+        rating = {rating}
+'''
+
+def write_to_annotation(entry_type, conn, cur, merge=False, rating_precedence='itunes'):
+    """Write the rolled-up play statistics of one item type, returning how many rows changed"""
+    cur.execute('DELETE FROM annotation_staging')
+    cur.execute('INSERT INTO annotation_staging SELECT ?, item_id, ?, play_count, play_date, rating FROM ('
+                + ANNOTATION_ROLLUPS[entry_type] + ')', (userID, entry_type))
+    if merge:
+        updates = ANNOTATION_MERGE.format(rating=RATING_PRECEDENCE[rating_precedence])
+    else:
+        updates = ANNOTATION_OVERWRITE
+
+    changes = conn.total_changes
+    cur.execute(ANNOTATION_WRITE.format(updates=updates))
+    changes = conn.total_changes - changes
+    conn.commit()
+    return changes
+
+def confirm_migration(merge=False):
     """Confirm migration with user"""
     print()
     print('This script will migrate data from your iTunes library to your Navidrome database.')
-    print('WARNING: This will DELETE existing annotation data in your Navidrome database!')
+    if merge:
+        print('WARNING: This will ADD the iTunes play counts to those of every matched song, album and')
+        print('artist in your Navidrome database. Running it twice counts the iTunes plays twice!')
+    else:
+        print('WARNING: This will OVERWRITE the play counts and play dates of every matched song, album')
+        print('and artist, and the ratings of every matched song, in your Navidrome database!')
+        print('Other annotation data is kept.')
     print('Make sure you have backed up your data. NO WARRANTIES. NO PROMISES.')
     print()
     
@@ -140,17 +243,69 @@ def confirm_migration():
 
 def main():
     parser = argparse.ArgumentParser(description='Migrate iTunes library data to Navidrome')
-    parser.add_argument('--library', type=Path, help='Path to iTunes Library.xml file')
+    parser.add_argument('--library', type=Path,
+                        help='Path to iTunes Library.xml file (may be gzip/bzip2/xz/zstd compressed, or - for stdin)')
     parser.add_argument('--database', type=Path, help='Path to Navidrome database file')
     parser.add_argument('--yes', action='store_true', help='Skip confirmation prompt')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='Parse the iTunes library and match its tracks with N worker processes (default: 1, streaming)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always re-parse the iTunes library instead of using its snapshot cache')
+    parser.add_argument('--parser', choices=PARSER_NAMES, default='auto',
+                        help='XML parser used to read the iTunes library (default: auto)')
+    parser.add_argument('--no-match-cache', action='store_true',
+                        help='Match every track again instead of reusing the matches saved by earlier runs')
+    parser.add_argument('--filter', action='append', default=[], metavar='CONDITION',
+                        help="Only migrate tracks meeting this condition, e.g. 'Kind=MPEG audio file', "
+                             "'!Podcast' or 'Date Added>=2015-01-01' (can be repeated)")
+    parser.add_argument('--music-only', action='store_true',
+                        help='Skip podcasts, videos and cloud-only tracks while reading the library')
+    parser.add_argument('--path-form', choices=PATH_FORMS, default='NFC',
+                        help='Unicode form both iTunes and Navidrome paths are compared in (default: NFC)')
+    parser.add_argument('--ignore-case', action='store_true',
+                        help='Compare paths case-insensitively (e.g. for libraries that came from Windows)')
+    parser.add_argument('--normalize-separators', action='store_true',
+                        help='Treat backslashes and repeated slashes in paths as single forward slashes')
+    parser.add_argument('--substring-match', action='store_true',
+                        help='Also match iTunes paths found anywhere inside a Navidrome path, '
+                             'not just at its end (e.g. when Navidrome paths have extra wrappers)')
+    parser.add_argument('--no-metadata-match', action='store_true',
+                        help='Do not fall back to matching tracks by size, duration and tags when their path is not found')
+    parser.add_argument('--rewrite-rules', type=Path, metavar='FILE',
+                        help="File of 'iTunes prefix => Navidrome prefix' rules for tracks outside the Music Folder")
+    parser.add_argument('--content-match', nargs='?', const='partial', choices=CONTENT_KINDS, metavar='KIND',
+                        help='Match remaining tracks by comparing file contents, either whole files (partial, the '
+                             'default) or only their audio, ignoring tags (audio); both the iTunes and the '
+                             'Navidrome files must be readable from this computer')
+    parser.add_argument('--io-jobs', type=int, default=HASH_WORKERS, metavar='N',
+                        help=f'Files read at the same time by --content-match (default: {HASH_WORKERS})')
+    parser.add_argument('--fuzzy-match', action='store_true',
+                        help='Match remaining tracks to the file with the most similar title, artist and duration')
+    parser.add_argument('--fuzzy-threshold', type=float, default=FUZZY_THRESHOLD, metavar='SCORE',
+                        help=f'Lowest similarity (0-1) accepted by --fuzzy-match (default: {FUZZY_THRESHOLD})')
+    parser.add_argument('--merge', action='store_true',
+                        help='Add iTunes play counts to those already in Navidrome and keep the later play date, '
+                             'instead of overwriting them')
+    parser.add_argument('--rating-precedence', choices=tuple(RATING_PRECEDENCE), default='itunes',
+                        help='Rating kept by --merge when both iTunes and Navidrome have one (default: itunes)')
     
     args = parser.parse_args()
+    if str(args.library) == STDIN and not (args.yes and args.database):
+        parser.error('reading the library from stdin needs --yes and --database')
+    conditions = args.filter + (list(MUSIC_ONLY_FILTER) if args.music_only else [])
+    try:
+        args.track_filter = RecordFilter(conditions) if conditions else None
+        args.rewriter = load_rewrite_rules(args.rewrite_rules) if args.rewrite_rules else PathRewriter()
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    args.match_options = MatchOptions(metadata=not args.no_metadata_match,
+                                      fuzzy_threshold=args.fuzzy_threshold if args.fuzzy_match else None)
     
     if not args.yes:
-        confirm_migration()
+        confirm_migration(args.merge)
     
     # Get file paths
-    if args.library and args.library.is_file():
+    if args.library and (str(args.library) == STDIN or args.library.is_file()):
         itdb_path = args.library
     else:
         itdb_path = get_file_path('iTunes library', auto_detect_itunes_library)
@@ -160,114 +315,145 @@ def main():
     else:
         nddb_path = get_file_path('Navidrome database', auto_detect_navidrome_db)
     
-    return itdb_path, nddb_path
+    return itdb_path, nddb_path, args
 
 if __name__ == '__main__':
-    itdb_path, nddb_path = main()
-
-    print('\nParsing iTunes library. This may take a while.')
-    with open(itdb_path, 'r', encoding="utf-8") as f: 
-        soup = BeautifulSoup(f, 'lxml-xml')
-
-    it_root_music_path = unquote(soup.find('key', text='Music Folder').next_sibling.text)
-    songs = soup.dict.dict.find_all('dict')
-    song_count = len(songs)
-    print(f'Found {song_count:,} files in iTunes database to process.')
-    del(soup)
-
-userID = determine_userID(nddb_path)
-songID_correlation = {} # we'll save this for later use to transfer Itunes playlists to ND (another script)
-artists = {}            # artists and albums will keep count of plays and play dates for each
-albums = {}
-files = {}
-
-
-status_interval = max(1, song_count // 8)
-counter = 0
-
-conn = sqlite3.connect(nddb_path)
-cur = conn.cursor()
-cur.execute('DELETE FROM annotation')
-conn.commit()
-
-# Pre-load all media file paths for faster lookup
-print('Loading Navidrome media file index...')
-cur.execute('SELECT id, path, artist_id, album_id FROM media_file')
-media_lookup = {row[1]: (row[0], row[2], row[3]) for row in cur.fetchall()}
-print(f'Loaded {len(media_lookup):,} media files from Navidrome database.')
-
-for it_song_entry in songs:
-    counter += 1    # progress tracking feedback
-    if counter % status_interval == 0:
-        print(f'{counter:,} files parsed so far of {song_count:,} total songs.')
-
-    # Skip entries without location data
-    location_key = it_song_entry.find('key', string='Location')
-    if location_key is None: 
-        continue
-
-    song_path = unquote(location_key.next_sibling.text)
-    if not song_path.startswith(it_root_music_path):  # excludes non-local content
-        continue   
-
-    song_path = re.sub(it_root_music_path, '', song_path)
-    # Normalize Unicode from decomposed (NFD) to composed (NFC) form for database matching
-    song_path = unicodedata.normalize('NFC', song_path)
-
-    # Fast lookup using pre-loaded media index
-    matching_files = [info for path, info in media_lookup.items() if song_path in path]
-    if not matching_files:
-        print(f"Error while parsing {song_path}. Navidrome does not acknowledge that file's existence.")
-        print("Maybe Navidrome doesn't like the extension? Skipping.")
-        continue
-    elif len(matching_files) > 1:
-        # If multiple matches, find exact match or best match
-        exact_match = next((info for path, info in media_lookup.items() if path.endswith(song_path)), None)
-        if exact_match:
-            song_id, artist_id, album_id = exact_match
-        else:
-            song_id, artist_id, album_id = matching_files[0]
-    else:
-        song_id, artist_id, album_id = matching_files[0]
+    itdb_path, nddb_path, args = main()
 
+    userID = determine_userID(nddb_path)
+    songID_correlation = {} # we'll save this for later use to transfer Itunes playlists to ND (another script)
+    ambiguous_matches = []  # (iTunes path, strategy, Decision) for tracks with several candidate files
 
-    # correlate Itunes ID with Navidrome ID (for use in a future script)
-    it_song_ID = int(it_song_entry.find('key', string='Track ID').next_sibling.text)
-    songID_correlation.update({it_song_ID: song_id})
-    
-    try:    # get rating, play count & date from Itunes
-        song_rating = int(it_song_entry.find('key', string='Rating').next_sibling.text)
-        song_rating = int(song_rating / 20)
-    except AttributeError: song_rating = 0 # rating = 0 (unrated) if it's not rated in itunes
-        
-    try:
-        play_count = int(it_song_entry.find('key', string='Play Count').next_sibling.text)
-        last_played = it_song_entry.find('key', string='Play Date UTC').next_sibling.text[:-1] # slice off the trailing 'Z'
-        last_played = datetime.datetime.strptime(last_played, '%Y-%m-%dT%H:%M:%S') # convert from string to datetime object. Example string: '2020-01-19T02:24:14Z'
-    except AttributeError: continue
 
-    update_playstats(artists, artist_id, play_count, last_played)
-    update_playstats(albums, album_id, play_count, last_played)
-    update_playstats(files, song_id, play_count, last_played, rating=song_rating)
+    status_interval = 10000
+    counter = 0
 
-    
+    conn = sqlite3.connect(nddb_path)
+    cur = conn.cursor()
+    cur.executescript(STAGING_TABLES)
+
+    # Pre-load all media file paths into a hash index for fast lookup
+    print('Loading Navidrome media file index...')
+    media_index = load_media_index(cur, PathCanonicalizer(args.path_form, args.ignore_case,
+                                                          args.normalize_separators))
+    print(f'Loaded {len(media_index):,} media files from Navidrome database.')
+
+    # Matches from earlier runs are reused as long as their media file is unchanged
+    match_cache = None
+    if not args.no_match_cache:
+        settings = repr((args.path_form, args.ignore_case, args.normalize_separators, args.substring_match,
+                         tuple(args.match_options)))
+        match_cache = MatchCache(match_cache_path(nddb_path), media_index, settings)
+        print(f'Loaded {len(match_cache):,} matches from earlier runs.')
+    content_queue = [] if args.content_match else None  # tracks no other matcher found
+
+    # Unless they come from the snapshot cache (or --jobs is used), tracks are streamed from the
+    # library one at a time, so matching starts while the file is still being read
+    print('\nParsing iTunes library.')
+    library_header = {}
+    songs = load_tracks(itdb_path, jobs=args.jobs, header=library_header, use_cache=not args.no_cache,
+                        parser=args.parser, record_filter=args.track_filter)
+    rewriter = args.rewriter
+    music_folder_added = False
+    pending = []    # tracks left for the fallback matchers in worker processes when --jobs is used
+    deferred = []   # tracks left for the --substring-match pass
+
+    for it_song_entry in songs:
+        counter += 1    # progress tracking feedback
+        if counter % status_interval == 0:
+            print(f'{counter:,} files parsed so far.')
+
+        if not music_folder_added:
+            # Paths under the Music Folder stay relative and are matched on their suffix,
+            # unless a rewrite rule says where Navidrome keeps them
+            rewriter.add(library_header['Music Folder'], '', replace=False)
+            music_folder_added = True
+
+        # Skip entries without location data
+        song_path = it_song_entry.location
+        if song_path is None:
+            continue
+
+        rewritten = rewriter.rewrite(song_path)
+        if rewritten is None:  # excludes non-local content
+            continue
+        navidrome_root, song_path = rewritten
+        # Bring the path into the same canonical form (Unicode form, case, separators) as the index
+        song_path = media_index.canonical(song_path)
+
+        match = None
+        if match_cache is not None:
+            match = match_cache.get(it_song_entry.persistent_id, navidrome_root + song_path)
+        if match is None:
+            # Fast lookup using pre-loaded media index
+            match = media_index.match(song_path, navidrome_root, it_song_entry)
+        if match is None and args.substring_match:
+            deferred.append((it_song_entry, song_path, navidrome_root))
+            continue
+        if match is None and args.jobs > 1:
+            pending.append((it_song_entry, song_path, navidrome_root))
+            continue
+        if match is None:
+            match = media_index.match_fallbacks(it_song_entry, args.match_options)
+        record_match(it_song_entry, song_path, match, navidrome_root)
+
+    if deferred:
+        # One pass over the Navidrome paths finds every remaining iTunes path inside them
+        print(f'Searching Navidrome paths for {len(deferred):,} unmatched files...')
+        substring_matches = media_index.match_substrings(song_path for _, song_path, _ in deferred)
+        for it_song_entry, song_path, navidrome_root in deferred:
+            match = substring_matches.get(song_path)
+            if match is None and args.jobs > 1:
+                pending.append((it_song_entry, song_path, navidrome_root))
+                continue
+            if match is None:
+                match = media_index.match_fallbacks(it_song_entry, args.match_options)
+            record_match(it_song_entry, song_path, match, navidrome_root)
+
+    if pending:
+        # The metadata and fuzzy matchers are CPU bound, so the tracks they need spread across the workers
+        print(f'Matching {len(pending):,} files by metadata with {args.jobs} worker processes...')
+        matches = match_fallbacks_parallel(media_index, [it_song_entry for it_song_entry, _, _ in pending],
+                                           args.jobs, args.match_options)
+        for (it_song_entry, song_path, navidrome_root), match in zip(pending, matches):
+            record_match(it_song_entry, song_path, match, navidrome_root)
+
+    if content_queue:
+        queued, content_queue = content_queue, None
+        print(f'Comparing the contents of {len(queued):,} unmatched files...')
+        digest_cache = DigestCache(digest_cache_path(nddb_path))
+        matches = media_index.match_content([it_song_entry for it_song_entry, _, _ in queued], args.content_match,
+                                            digest_cache, args.io_jobs, exclude=set(songID_correlation.values()))
+        digest_cache.close()
+        for (it_song_entry, song_path, navidrome_root), match in zip(queued, matches):
+            record_match(it_song_entry, song_path, match, navidrome_root)
+
+    if match_cache is not None:
+        match_cache.close()
+    print(f'Processed {counter:,} files from the iTunes database.')
+
+    print('Writing changes to database:')
+    changed = write_to_annotation('artist', conn, cur, args.merge, args.rating_precedence)
+    print(f'Done writing artist records to database ({changed:,} changed).')
+    changed = write_to_annotation('media_file', conn, cur, args.merge, args.rating_precedence)
+    print(f'Done writing music file records to database ({changed:,} changed).')
+    changed = write_to_annotation('album', conn, cur, args.merge, args.rating_precedence)
+    print(f'Album records saved to database ({changed:,} changed).')
+
+    conn.close()
 
-print('Writing changes to database:')
-write_to_annotation(artists, 'artist', conn, cur)
-print('Done writing artist records to database.')
-write_to_annotation(files, 'media_file', conn, cur)
-print('Done writing music file records to database.')
-write_to_annotation(albums, 'album', conn, cur)
-print('Album records saved to database.')
-
-conn.close()
-
-with open('IT_file_correlations.py', 'w') as f:
-    f.write('# Following python dictionary correlates the itunes integer ID to the Navidrome file ID for each song.\n')
-    f.write('# {ITUNES ID: ND ID} is the format. \n\n')
-    f.write('itunes_correlations = ')
-    f.write(pprint.pformat(songID_correlation))
-
-print('Navidrome database updated.')
-print(f"File correlation index saved to {str(Path.cwd() / 'IT_file_correlations.py')}\n")
-print('You can delete it if you want, but I will use it later in a script to transfer playlists from Itunes to Navidrome.')
+    with open('IT_file_correlations.py', 'w') as f:
+        f.write('# Following python dictionary correlates the itunes integer ID to the Navidrome file ID for each song.\n')
+        f.write('# {ITUNES ID: ND ID} is the format. \n\n')
+        f.write('itunes_correlations = ')
+        f.write(pprint.pformat(songID_correlation))
+
+    print('Navidrome database updated.')
+    if ambiguous_matches:
+        write_ambiguous_matches(ambiguous_matches, 'IT_ambiguous_matches.csv')
+        print(f'{len(ambiguous_matches):,} tracks matched several Navidrome files; the choices made are listed in '
+              f"{Path.cwd() / 'IT_ambiguous_matches.csv'}")
+    elif os.path.exists('IT_ambiguous_matches.csv'):
+        os.remove('IT_ambiguous_matches.csv')   # left over from an earlier run
+    print(f"File correlation index saved to {str(Path.cwd() / 'IT_file_correlations.py')}\n")
+    print('You can delete it if you want, but I will use it later in a script to transfer playlists from Itunes to Navidrome.')